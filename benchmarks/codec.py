@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+""" Compare requests' JSON handling with earwig.codec
+
+usage: python benchmarks/codec.py [-n REPEAT] [PAGES.json ...]
+
+Decoding runs r.json() on getAndroidMetricsReports responses, as earwig
+used to, against each codec's loads(r.content). Encoding prepares request
+bodies with requests' json= against a codec's bytes. Without arguments
+synthetic pages are generated.
+"""
+import argparse
+import os
+import requests
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from earwig import codec, driver
+import reports
+
+
+def _response(page, offset):
+    r = requests.models.Response()
+    r.status_code = 200
+    r.headers['Content-Type'] = 'application/json; charset=utf-8'
+    r._content = codec.JsonCodec().dumps(
+        dict(result={'1': page, '2': offset}, xsrf='xsrf-0'))
+    return r
+
+
+def _best(fn, repeat):
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark JSON codecs")
+    parser.add_argument('-n', '--repeat', type=int, default=5,
+                        help='report the best of this many runs')
+    parser.add_argument('pages', nargs='*',
+                        help='recorded getAndroidMetricsReports pages')
+    opts = parser.parse_args()
+
+    pages = reports.load_pages(opts.pages) if opts.pages \
+        else reports.synthetic_pages()
+    responses = [_response(page, str(ix)) for ix, page in enumerate(pages)]
+    size = sum(len(r.content) for r in responses)
+    expected = [r.json() for r in responses]
+    print '%d responses, %.1f MB' % (len(responses), size / 1e6)
+
+    print 'decode'
+    seconds = _best(lambda: [r.json() for r in responses], opts.repeat)
+    print '  %-12s %8.1f MB/s' % ('r.json()', size / 1e6 / seconds)
+    for name, c in sorted(codec.CODECS.iteritems()):
+        if [c.loads(r.content) for r in responses] != expected:
+            print >>sys.stderr, '%s decodes differently' % name
+            sys.exit(1)
+        seconds = _best(lambda: [c.loads(r.content) for r in responses],
+                        opts.repeat)
+        print '  %-12s %8.1f MB/s' % (name, size / 1e6 / seconds)
+
+    params = [driver.f('com.example', 'cluster-%d' % ix,
+                       driver.f('1500000000000'), driver.f('1500003600000'),
+                       driver.REPORTS_PAGE_SIZE, str(ix))
+              for ix in xrange(1000)]
+    url = driver.ERRORREPORTS_URL
+
+    def prepare_json():
+        for p in params:
+            data = dict(method='getAndroidMetricsReports', xsrf='xsrf-0',
+                        params=codec.UjsonCodec().dumps(p))
+            requests.Request('POST', url, json=data).prepare()
+
+    def prepare_codec(c):
+        for p in params:
+            body = c.dumps(dict(method='getAndroidMetricsReports',
+                                xsrf='xsrf-0', params=c.dumps(p)))
+            requests.Request('POST', url, data=body).prepare()
+
+    print 'encode'
+    seconds = _best(prepare_json, opts.repeat)
+    print '  %-12s %8.1f us/request' % ('json=', seconds * 1e6 / len(params))
+    for name, c in sorted(codec.CODECS.iteritems()):
+        seconds = _best(lambda: prepare_codec(c), opts.repeat)
+        print '  %-12s %8.1f us/request' % (name, seconds * 1e6 / len(params))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+""" Compare plain and dictionary-encoded (--compact) outputs
+
+usage: python benchmarks/compact.py [PAGES.json ...]
+
+Without arguments the pages of a synthetic hot cluster are generated,
+whose threads share a few distinct stacks.
+"""
+import argparse
+import os
+import sys
+import time
+import ujson
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from earwig import formats
+import reports
+
+
+def _encode(flattened, compact):
+    encoder = compact and formats.FrameEncoder(stacks=compact == 'stacks')
+    lines = []
+    for report in flattened:
+        records = encoder.encode(report) if encoder else [report]
+        lines.extend(ujson.dumps(record) for record in records)
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark compact outputs")
+    parser.add_argument('-l', '--level', type=int, default=6,
+                        help='gzip level of the compressed sizes')
+    parser.add_argument('pages', nargs='*',
+                        help='recorded getAndroidMetricsReports pages')
+    opts = parser.parse_args()
+
+    pages = reports.load_pages(opts.pages) if opts.pages \
+        else reports.hot_cluster_pages()
+    flatten = formats.compile_spec(formats.REPORT_SPEC)
+    flattened = [report for page in pages for report in flatten(page)]
+    print '%d reports' % len(flattened)
+
+    for compact in (None, 'frames', 'stacks'):
+        start = time.time()
+        text = _encode(flattened, compact)
+        encoded = time.time() - start
+        start = time.time()
+        expanded = list(formats.expand_reports(
+            ujson.loads(line) for line in text.splitlines() if line))
+        decoded = time.time() - start
+        if expanded != flattened:
+            print >>sys.stderr, '%s does not expand to its input' % compact
+            sys.exit(1)
+        print '%-7s %8.2f MB %8.2f MB gzipped  encode %6.3fs  read %6.3fs' % (
+            compact or 'plain', len(text) / 1e6,
+            len(zlib.compress(text, opts.level)) / 1e6, encoded, decoded)
+
+
+if __name__ == '__main__':
+    main()
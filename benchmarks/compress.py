@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+""" Compare gzip.open against block-parallel output.Compressor
+
+usage: python benchmarks/compress.py [-l LEVEL] [-z THREADS ...] [PAGES.json ...]
+
+Reports are flattened and serialized once, then written to a temporary
+.json.gz file. Without arguments synthetic pages are generated.
+"""
+import argparse
+import gzip
+import os
+import sys
+import tempfile
+import time
+import ujson
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from earwig import formats, output
+import reports
+
+
+def _write(fp, lines):
+    for line in lines:
+        fp.write(line)
+        fp.write('\n')
+    fp.close()
+
+
+def _check(path, lines):
+    with gzip.open(path, 'rb') as f:
+        if f.read() != ''.join(line + '\n' for line in lines):
+            print >>sys.stderr, '%s does not decompress to its input' % path
+            sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark gzip outputs")
+    parser.add_argument('-l', '--level', type=int, default=6)
+    parser.add_argument('-z', '--threads', type=int, nargs='+',
+                        default=[1, 2, 4, 8])
+    parser.add_argument('-r', '--repeat', type=int, default=4,
+                        help='write the reports this many times')
+    parser.add_argument('pages', nargs='*',
+                        help='recorded getAndroidMetricsReports pages')
+    opts = parser.parse_args()
+
+    pages = reports.load_pages(opts.pages) if opts.pages \
+        else reports.synthetic_pages()
+    flatten = formats.compile_spec(formats.REPORT_SPEC)
+    lines = [ujson.dumps(report) for page in pages
+             for report in flatten(page)] * opts.repeat
+    mb = sum(len(line) + 1 for line in lines) / 1e6
+
+    fd, path = tempfile.mkstemp(suffix='.json.gz')
+    os.close(fd)
+    try:
+        print '%d reports, %.1f MB, level %d' % (len(lines), mb, opts.level)
+        start = time.time()
+        _write(gzip.open(path, 'wb', opts.level), lines)
+        elapsed = time.time() - start
+        print 'gzip.open:     %8.3fs %8.1f MB/s %8.2f MB' % (
+            elapsed, mb / elapsed, os.path.getsize(path) / 1e6)
+        for threads in opts.threads:
+            compressor = output.Compressor(opts.level, threads)
+            start = time.time()
+            _write(compressor.open(path), lines)
+            elapsed = time.time() - start
+            compressor.close()
+            _check(path, lines)
+            print 'Compressor(%d): %8.3fs %8.1f MB/s %8.2f MB' % (
+                threads, elapsed, mb / elapsed, os.path.getsize(path) / 1e6)
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+""" A local stand-in for the Play Console errorreports endpoint
+
+usage: python benchmarks/fakeplay.py [-p PORT] [--clusters N] [--reports N]
+                                     [--recorded PAGES.json ...]
+
+Point earwig at it with --endpoint http://localhost:PORT/errorreports, or a
+PlayDriver with url=.
+"""
+import argparse
+import base64
+import os
+import random
+import sys
+import threading
+import time
+import ujson
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import reports
+
+
+def _encode_offset(ix):
+    return base64.urlsafe_b64encode('offset:%d' % ix)
+
+
+def _decode_offset(offset):
+    if offset is None:
+        return 0
+    return int(base64.urlsafe_b64decode(str(offset)).split(':')[1])
+
+
+class FakePlay(object):
+    """ Synthetic clusters and reports served like the real endpoint """
+    def __init__(self, clusters=20, reports_per_cluster=30, threads=5,
+                 frames=10, latency=0, throttle=0, skew=0, seed=0, span=None,
+                 page_size=None, xsrf_every=0, reject_stale=False,
+                 recorded=None):
+        self.latency = latency
+        self.span = span
+        # Pages hold at most page_size entries, whatever the limit asked
+        self.page_size = page_size
+        # A new xsrf token is handed out every xsrf_every requests
+        self.xsrf_every = xsrf_every
+        self.xsrf = 'xsrf-0'
+        self.previous_xsrf = None
+        self.stale_xsrf = 0
+        # Answer requests with a stale xsrf token 403, as once it expired
+        self.reject_stale = reject_stale
+        self.throttle = throttle
+        self.throttled = 0
+        self.clusters = ['cluster-%04d' % ix for ix in xrange(clusters)]
+        rnd = random.Random(seed)
+        self.rnd = random.Random(seed)
+        self.reports = {}
+        ix = 0
+        for cluster_ix, cluster_id in enumerate(self.clusters):
+            # With skew, cluster sizes grow along the listing order
+            size = int(reports_per_cluster *
+                       (1 + skew * cluster_ix) / (1 + skew * clusters / 2.))
+            page = []
+            for report_ix in xrange(max(1, size)):
+                report = reports.synthetic_report(rnd, ix, threads, frames)
+                if span:
+                    # Spread the cluster evenly over [0, span) seconds
+                    report['2']['1'] = str(span * 1000 * report_ix / size)
+                page.append(report)
+                ix += 1
+            self.reports[cluster_id] = page
+        if recorded:
+            # Deal recorded reports out to the clusters
+            for cluster_id in self.clusters:
+                self.reports[cluster_id] = []
+            for ix, report in enumerate(recorded):
+                cluster_id = self.clusters[ix % len(self.clusters)]
+                self.reports[cluster_id].append(report)
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def _page(self, entries, limit, offset):
+        start = _decode_offset(offset)
+        if self.page_size:
+            limit = min(limit, self.page_size)
+        end = start + limit
+        rv = {'1': entries[start:end]}
+        if end < len(entries):
+            rv['2'] = _encode_offset(end)
+        return rv
+
+    def listAndroidMetricsErrorClusters(self, params):
+        entries = [{'1': cluster_id} for cluster_id in self.clusters]
+        return self._page(entries, params['6'], params.get('7'))
+
+    def getAndroidMetricsReports(self, params):
+        entries = self.reports.get(params['2'], [])
+        if self.span:
+            # Both ends are inclusive, so adjacent windows overlap
+            start = int(params['3']['1']) * 1000
+            end = int(params['4']['1']) * 1000
+            entries = [e for e in entries if start <= int(e['2']['1']) <= end]
+        return self._page(entries, params['5'], params.get('6'))
+
+    def getAndroidMetricsClusterStatistics(self, params):
+        return {'1': [{'1': cluster_id,
+                       '2': str(len(self.reports.get(cluster_id, [])))}
+                      for cluster_id in params['4']]}
+
+    def handle(self, request):
+        """ Answer a decoded request body with a response dict, or None
+        for a 403 """
+        with self.lock:
+            self.requests += 1
+            throttled = self.rnd.random() < self.throttle
+            if throttled:
+                self.throttled += 1
+            if request.get('xsrf') not in (self.xsrf, self.previous_xsrf):
+                self.stale_xsrf += 1
+                if self.reject_stale:
+                    return None
+            if self.xsrf_every and not self.requests % self.xsrf_every:
+                self.previous_xsrf = self.xsrf
+                self.xsrf = 'xsrf-%d' % self.requests
+            xsrf = self.xsrf
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            return {'error': {'code': 6800004}}
+        method = getattr(self, request['method'], None)
+        if method is None:
+            return {'error': {'code': 404}}
+        result = method(ujson.loads(request['params']))
+        return {'result': result, 'xsrf': xsrf}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length', 0))
+        request = ujson.loads(self.rfile.read(length))
+        response = self.server.fake.handle(request)
+        if response is None:
+            self.send_error(403)
+            return
+        body = ujson.dumps(response)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(fake, port=0):
+    """ Serve fake on a background thread, returning the endpoint url """
+    server = _Server(('127.0.0.1', port), _Handler)
+    server.fake = fake
+    thread = threading.Thread(target=server.serve_forever, name='fakeplay')
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d/errorreports' % server.server_port
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake errorreports endpoint")
+    parser.add_argument('-p', '--port', type=int, default=8080)
+    parser.add_argument('--clusters', type=int, default=20)
+    parser.add_argument('--reports', type=int, default=30)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--throttle', type=float, default=0,
+                        help='fraction of requests failing with 6800004')
+    parser.add_argument('--skew', type=float, default=0,
+                        help='grow cluster sizes along the listing order')
+    parser.add_argument('--page-size', type=int,
+                        help='cap the entries per page')
+    parser.add_argument('--xsrf-every', type=int, default=0,
+                        help='rotate the xsrf token every N requests')
+    parser.add_argument('--reject-stale', action='store_true',
+                        help='answer requests with a stale xsrf token 403')
+    parser.add_argument('--recorded', nargs='+',
+                        help='serve the reports of recorded pages instead')
+    opts = parser.parse_args()
+    recorded = opts.recorded and [report for page in
+                                  reports.load_pages(opts.recorded)
+                                  for report in page]
+    fake = FakePlay(opts.clusters, opts.reports, latency=opts.latency,
+                    throttle=opts.throttle, skew=opts.skew,
+                    page_size=opts.page_size, xsrf_every=opts.xsrf_every,
+                    reject_stale=opts.reject_stale, recorded=recorded)
+    server, url = serve(fake, opts.port)
+    print 'Serving %s' % url
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+""" Compare formats.flatten against formats.compile_spec on report pages
+
+usage: python benchmarks/flatten.py [-n REPEAT] [PAGES.json ...]
+
+Without arguments synthetic pages are generated.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from earwig import formats
+import reports
+
+
+def _best_of(fn, pages, repeat):
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        for page in pages:
+            fn(page)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark report flattening")
+    parser.add_argument('-n', '--repeat', type=int, default=5)
+    parser.add_argument('pages', nargs='*',
+                        help='recorded getAndroidMetricsReports pages')
+    opts = parser.parse_args()
+
+    pages = reports.load_pages(opts.pages) if opts.pages \
+        else reports.synthetic_pages()
+    n = sum(len(page) for page in pages)
+
+    spec = formats.REPORT_SPEC
+    compiled = formats.compile_spec(spec)
+    for page in pages:
+        if compiled(page) != formats.flatten(page, spec):
+            print >>sys.stderr, 'compiled output differs from flatten'
+            sys.exit(1)
+
+    interpreted = _best_of(lambda page: formats.flatten(page, spec),
+                           pages, opts.repeat)
+    fast = _best_of(compiled, pages, opts.repeat)
+    print '%d pages, %d reports' % (len(pages), n)
+    print 'flatten:      %8.3fs %10.0f reports/s' % (interpreted, n / interpreted)
+    print 'compile_spec: %8.3fs %10.0f reports/s' % (fast, n / fast)
+    print 'speedup:      %8.2fx' % (interpreted / fast)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+""" Report pages for benchmarks, either recorded or synthetic """
+import gzip
+import random
+import ujson
+
+
+def _frame(rnd, ix):
+    return {
+        "1": "com.example.Worker.method%d" % rnd.randint(0, 200),
+        "2": "Worker%d.java" % rnd.randint(0, 50),
+        "3": str(rnd.randint(1, 2000)),
+        "5": "libexample.so",
+        "6": str(rnd.randint(0, 1 << 30)),
+        "7": str(rnd.randint(0, 4096)),
+        "8": ix % 3 == 0,
+        "9": {"1": "com.example.Worker%d" % rnd.randint(0, 50),
+              "2": "method%d" % rnd.randint(0, 200)}
+    }
+
+
+def _thread(rnd, ix, frames):
+    return {
+        "1": "\"Thread-%d\" prio=5 tid=%d Waiting" % (ix, ix + 1),
+        "2": [_frame(rnd, f) for f in xrange(frames)],
+        "3": {"1": "Thread-%d" % ix,
+              "2": {"2": str(ix + 1), "3": ix != 0, "4": "0x%x" % ix}},
+        "4": {"1": str(rnd.randint(0, 1 << 30)),
+              "2": "java.lang.Object",
+              "3": str(rnd.randint(1, 40))},
+        "5": ix != 0,
+        "6": {"1": "state"}
+    }
+
+
+def synthetic_report(rnd, ix, threads=20, frames=25):
+    """ Build a raw getAndroidMetricsReports entry matching REPORT_SPEC """
+    return {
+        "1": "report-%08d" % ix,
+        "2": {"1": str(1500000000000 + ix * 1000), "2": "-25200"},
+        "3": {
+            "2": {
+                "1": "Input dispatching timed out",
+                "2": "com.example/.MainActivity",
+                "3": [_thread(rnd, t, frames) for t in xrange(threads)],
+                "6": "Broadcast of Intent",
+                "7": "ANR",
+                "8": "com.example/.Receiver",
+                "9": {"1": "Alt title", "2": "Worker.java:42", "3": "x"}
+            }
+        },
+        "4": {"1": str(rnd.randint(100, 200))},
+        "5": rnd.choice(["7.0", "8.1", "9", "10"]),
+        "6": "device-%d" % rnd.randint(0, 1000),
+        "7": {"1": "dev", "2": "Pixel", "3": "Google", "4": "msm",
+              "5": "board", "7": "420", "8": "1080", "9": "1920",
+              "10": "3.2"}
+    }
+
+
+def synthetic_pages(pages=50, page_size=10, threads=20, frames=25, seed=0):
+    """ Generate pages of synthetic reports, deterministic for a given seed """
+    rnd = random.Random(seed)
+    return [[synthetic_report(rnd, p * page_size + r, threads, frames)
+             for r in xrange(page_size)]
+            for p in xrange(pages)]
+
+
+def load_pages(paths):
+    """ Load recorded pages: one JSON list of reports per line, or per file """
+    pages = []
+    for path in paths:
+        open_fn = gzip.open if path.endswith('.gz') else open
+        with open_fn(path, 'rb') as f:
+            text = f.read()
+        try:
+            data = ujson.loads(text)
+        except ValueError:
+            data = [ujson.loads(line) for line in text.splitlines() if line]
+        else:
+            data = [data]
+        for page in data:
+            if isinstance(page, dict):
+                page = page.get('1', [page])
+            pages.append(page)
+    return pages
+
+
+def hot_cluster_pages(pages=50, page_size=10, threads=20, frames=25,
+                      stacks=40, seed=0):
+    """ Pages of a hot cluster, whose threads share a few distinct stacks """
+    rnd = random.Random(seed)
+    pool = [[_frame(rnd, f) for f in xrange(frames)] for _ in xrange(stacks)]
+    rv = []
+    for p in xrange(pages):
+        page = []
+        for r in xrange(page_size):
+            report = synthetic_report(rnd, p * page_size + r, threads, 0)
+            for thread in report['3']['2']['3']:
+                thread['2'] = rnd.choice(pool)
+            page.append(report)
+        rv.append(page)
+    return rv
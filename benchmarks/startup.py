@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+""" Measure earwig's startup time and check the headless path stays lean
+
+usage: python benchmarks/startup.py [-n REPEAT] [--max-seconds S]
+
+Each module is imported in a fresh interpreter and its import time
+reported. Then a headless run is replayed from an empty response cache,
+which goes through argument parsing, timestamps and driver setup without
+touching the network. It fails if that imports selenium, bs4 or
+dateparser, or takes longer than --max-seconds.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+MODULES = ('ujson', 'requests', 'earwig.formats', 'earwig.output',
+           'earwig.driver', 'earwig.cli', 'selenium.webdriver', 'bs4',
+           'dateparser')
+
+# Only needed to log in or to parse free-form timestamps
+HEAVY = ('selenium', 'bs4', 'dateparser')
+
+IMPORT = """
+import sys, time
+sys.path.insert(0, %r)
+start = time.time()
+import %s
+print time.time() - start
+"""
+
+
+def child(argv):
+    """ Replay a headless run, printing its startup time and heavy modules """
+    start = time.time()
+    sys.path.insert(0, ROOT)
+    from earwig import cli
+    cache_dir = argv[0]
+    sys.argv = ['earwig', '-H', '-q', '-f', '2017-01-01 00:00',
+                '-t', '2017-01-01T01:00:00Z', '-o', '-', '--cache', cache_dir,
+                '--replay', 'account', 'com.example']
+    stderr, sys.stderr = sys.stderr, open(os.devnull, 'w')
+    try:
+        cli.main()
+    except (SystemExit, Exception):
+        # The empty cache fails the run once the driver is set up
+        pass
+    finally:
+        sys.stderr = stderr
+    print json.dumps(dict(
+        seconds=time.time() - start,
+        heavy=sorted(set(m.split('.')[0] for m in sys.modules) &
+                     set(HEAVY))))
+
+
+def _best(cmd, repeat):
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        out = subprocess.check_output(cmd)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, out
+
+
+def main():
+    if sys.argv[1:2] == ['--child']:
+        child(sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(description="Benchmark startup time")
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+                        help='report the best of this many runs')
+    parser.add_argument('--max-seconds', type=float,
+                        help='fail if the headless run takes longer')
+    opts = parser.parse_args()
+
+    print 'import time in a fresh interpreter'
+    for module in MODULES:
+        cmd = [sys.executable, '-c', IMPORT % (ROOT, module)]
+        try:
+            seconds = min(float(subprocess.check_output(
+                cmd, stderr=open(os.devnull, 'w'))) for _ in
+                xrange(opts.repeat))
+        except subprocess.CalledProcessError:
+            print '  %-20s not installed' % module
+            continue
+        print '  %-20s %8.1f ms' % (module, seconds * 1000)
+
+    cache_dir = tempfile.mkdtemp(prefix='earwig-startup')
+    try:
+        wall, out = _best([sys.executable, __file__, '--child', cache_dir],
+                          opts.repeat)
+    finally:
+        shutil.rmtree(cache_dir, True)
+    rv = json.loads(out.splitlines()[-1])
+    print 'headless run: %.1f ms in process, %.1f ms with the interpreter' % (
+        rv['seconds'] * 1000, wall * 1000)
+    failed = False
+    if rv['heavy']:
+        print >>sys.stderr, 'headless run imported %s' % ', '.join(rv['heavy'])
+        failed = True
+    if opts.max_seconds and wall > opts.max_seconds:
+        print >>sys.stderr, 'headless run took over %.2f s' % opts.max_seconds
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+""" Measure earwig against benchmarks/fakeplay.py across -j and engines
+
+usage: python benchmarks/throughput.py [-j N ...] [-e ENGINE ...]
+                                       [--latency SECONDS] [--throttle P]
+                                       [--max-rate N]
+                                       [--recorded PAGES.json ...]
+
+Each configuration runs the earwig CLI in a child process, so peak RSS is
+its own. Reported are reports/s, p50/p99 request latency as seen by the
+client, and peak RSS. Requests go through earwig's default rate limiting,
+or --max-rate if given.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import fakeplay
+import reports
+
+
+def _percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.))]
+
+
+def child(argv):
+    """ Run the earwig CLI in this process, printing its measurements """
+    import requests
+    from earwig import cli, driver, output
+
+    url, out_dir = argv[:2]
+    state_path = os.path.join(out_dir, 'state.json')
+    with open(state_path, 'wb') as f:
+        json.dump(dict(cookies={'SID': 'fake'}, xsrf='xsrf-0', gwt='fake'), f)
+    driver.PlayDriver.STATE_PATH = state_path
+
+    latencies = []
+    post = requests.Session.post
+
+    def timed_post(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return post(self, *args, **kwargs)
+        finally:
+            latencies.append(time.time() - start)
+    requests.Session.post = timed_post
+
+    path = os.path.join(out_dir, 'out.json.gz')
+    sys.argv = ['earwig', '-H', '-q', '-f', '2017-01-01 00:00', '-o', path,
+                '--endpoint', url] + argv[2:] + ['account', 'com.example']
+    rc = 0
+    start = time.time()
+    try:
+        cli.main()
+    except SystemExit as e:
+        rc = e.code
+    elapsed = time.time() - start
+    n = sum(1 for _ in output.read_reports(path)) if rc == 0 else 0
+    print json.dumps(dict(
+        rc=rc, reports=n, seconds=elapsed, requests=len(latencies),
+        p50=_percentile(latencies, 50), p99=_percentile(latencies, 99),
+        max_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.))
+
+
+def _run(url, args):
+    out_dir = tempfile.mkdtemp(prefix='earwig-bench')
+    try:
+        cmd = [sys.executable, __file__, '--child', url, out_dir] + args
+        return json.loads(subprocess.check_output(cmd).splitlines()[-1])
+    finally:
+        shutil.rmtree(out_dir, True)
+
+
+def main():
+    if sys.argv[1:2] == ['--child']:
+        child(sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(description="Benchmark throughput")
+    parser.add_argument('-j', '--threads', type=int, nargs='+',
+                        default=[1, 4, 16])
+    parser.add_argument('-e', '--engines', nargs='+',
+                        default=['threads', 'async'])
+    parser.add_argument('--clusters', type=int, default=40)
+    parser.add_argument('--reports', type=int, default=50,
+                        help='reports per cluster')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds the server takes per request')
+    parser.add_argument('--throttle', type=float, default=0,
+                        help='fraction of requests failing with 6800004')
+    parser.add_argument('--page-size', type=int)
+    parser.add_argument('--xsrf-every', type=int, default=100)
+    parser.add_argument('--max-rate', type=float, metavar='N',
+                        help="pass --max-rate N to earwig (default: earwig's "
+                        "own default)")
+    parser.add_argument('--recorded', nargs='+',
+                        help='serve the reports of recorded pages instead')
+    opts = parser.parse_args()
+
+    recorded = opts.recorded and [report for page in
+                                  reports.load_pages(opts.recorded)
+                                  for report in page]
+    fake = fakeplay.FakePlay(opts.clusters, opts.reports,
+                             latency=opts.latency, throttle=opts.throttle,
+                             page_size=opts.page_size,
+                             xsrf_every=opts.xsrf_every, recorded=recorded)
+    server, url = fakeplay.serve(fake)
+    print '%d clusters, %d reports, %.0f ms latency' % (
+        len(fake.clusters), sum(len(r) for r in fake.reports.itervalues()),
+        opts.latency * 1000)
+    print '%-8s %4s %8s %10s %8s %8s %8s %8s' % (
+        'engine', '-j', 'reports', 'reports/s', 'requests', 'p50 ms',
+        'p99 ms', 'RSS MB')
+    try:
+        for engine in opts.engines:
+            for threads in opts.threads:
+                args = ['-e', engine, '-j', str(threads)]
+                if opts.max_rate:
+                    args += ['--max-rate', str(opts.max_rate)]
+                rv = _run(url, args)
+                if rv['rc']:
+                    print >>sys.stderr, '%s -j %d failed with %s' % (
+                        engine, threads, rv['rc'])
+                print '%-8s %4d %8d %10.1f %8d %8.1f %8.1f %8.1f' % (
+                    engine, threads, rv['reports'],
+                    rv['reports'] / rv['seconds'], rv['requests'],
+                    rv['p50'] * 1000, rv['p99'] * 1000, rv['max_rss_mb'])
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
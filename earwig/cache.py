@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+import hashlib
+import logging
+import os
+import threading
+import time
+import ujson
+import zlib
+
+from output import write_atomically
+
+
+# Eviction frees space down to this fraction of max_bytes
+LOW_WATER = 0.9
+
+
+class ResponseCache(object):
+    """ Results of errorreports commands on disk, compressed
+
+    Entries are keyed by account, command and parameters, and only results
+    of windows that ended over `settle` seconds ago are cached, as reports
+    of recent windows keep arriving. Entries expire `ttl` seconds after
+    being written. Once the cache holds more than `max_bytes`, the least
+    recently read entries are evicted.
+
+    With `replay`, the cache stands in for the network: a miss is an error
+    instead of a request, and expired entries are still served.
+    """
+    def __init__(self, path, ttl=30 * 86400, max_bytes=1 << 30,
+                 settle=6 * 3600, replay=False, level=6):
+        self.logger = logging.getLogger('cache')
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.settle = settle
+        self.replay = replay
+        self.level = level
+        self.lock = threading.Lock()
+        self.size = None
+
+    def is_closed(self, end_time):
+        return int(end_time) + self.settle <= time.time()
+
+    def _entry(self, account, cmd, params):
+        key = hashlib.sha1(ujson.dumps([account, cmd, params],
+                                       sort_keys=True)).hexdigest()
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def get(self, account, cmd, params):
+        """ The cached result, or None """
+        path = self._entry(account, cmd, params)
+        try:
+            st = os.stat(path)
+            if not self.replay and st.st_mtime + self.ttl <= time.time():
+                self._discard(path, st.st_size)
+                return None
+            with open(path, 'rb') as f:
+                data = f.read()
+            # The access time orders eviction, the modification time expiry
+            os.utime(path, (time.time(), st.st_mtime))
+        except (IOError, OSError):
+            return None
+        try:
+            return ujson.loads(zlib.decompress(data))
+        except (ValueError, zlib.error):
+            self.logger.warn("Discarding corrupt cache entry %s", path)
+            self._discard(path, len(data))
+            return None
+
+    def _discard(self, path, size):
+        """ Remove an entry of `size` bytes """
+        try:
+            os.unlink(path)
+        except OSError:
+            return
+        with self.lock:
+            if self.size is not None:
+                self.size -= size
+
+    def put(self, account, cmd, params, result):
+        path = self._entry(account, cmd, params)
+        data = zlib.compress(ujson.dumps(result), self.level)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):
+                    raise
+        try:
+            replaced = os.stat(path).st_size
+        except OSError:
+            replaced = 0
+        write_atomically(path, data)
+        with self.lock:
+            if self.size is None:
+                self.size = sum(st.st_size for _, st in self._entries())
+            else:
+                self.size += len(data) - replaced
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                if filename.startswith('.'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    yield path, os.stat(path)
+                except OSError:
+                    pass
+
+    def _evict(self):
+        """ Drop expired entries, then the least recently read ones """
+        now = time.time()
+        entries = sorted(self._entries(),
+                         key=lambda (_, st): (st.st_mtime + self.ttl > now,
+                                              st.st_atime))
+        size = sum(st.st_size for _, st in entries)
+        target = self.max_bytes * LOW_WATER
+        evicted = 0
+        for path, st in entries:
+            if size <= target and st.st_mtime + self.ttl > now:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            size -= st.st_size
+            evicted += 1
+        self.size = size
+        self.logger.debug("Evicted %d cache entries, %.1f MB left",
+                          evicted, size / 1e6)
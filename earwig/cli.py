@@ -1,129 +1,795 @@
 #!/usr/bin/env python
+import calendar
+import collections
+import columnar
+import datetime
+import engine
 import formats
 import logging
+import metrics
 import Queue
+import ratelimit
+import re
 import threading
+import tracing
 import ujson
 import sys
 import time
 
-from driver import PlayDriver
+from cache import ResponseCache
+from driver import CLUSTER_STATISTICS_BATCH, ERRORREPORTS_URL, \
+    REPORTS_PAGE_SIZE, PlayDriver, cluster_sizes
+from output import Compressor, Output, SegmentedOutput, makedirs_for
+from transport import Transport
+
+
+# Clusters needing more round trips than this are split across workers
+SPLIT_ROUND_TRIPS = 10
+# ...into slices of at least this many seconds
+MIN_SPLIT_SECONDS = 60
 
 
 def _thread_raise(thread, exception):
+    """ Raise exception in thread, or clear the pending one with None """
     import ctypes
     set_async_exc = ctypes.pythonapi.PyThreadState_SetAsyncExc
     ret = set_async_exc(ctypes.c_long(thread.ident),
-                        ctypes.py_object(exception))
+                        None if exception is None
+                        else ctypes.py_object(exception))
     if ret > 1:
         set_async_exc(thread.ident, 0)
 
 
+_worker_flatten = None
+
+
+def _init_flatten_worker():
+    global _worker_flatten
+    import signal
+    # Ctrl-C is handled by the main process, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_flatten = formats.compile_spec(formats.REPORT_SPEC)
+
+
+def _flatten_in_worker(reports):
+    return _worker_flatten(reports)
+
+
+def flatten_pool(workers):
+    """ A process pool for Earwig's pool argument, to be forked before any
+    thread is started """
+    import multiprocessing
+    return multiprocessing.Pool(workers, initializer=_init_flatten_worker)
+
+
+def _makespan(costs, workers):
+    """ Completion time of costs dispatched in order to idle workers """
+    import heapq
+    finish = [0] * max(1, workers)
+    for cost in costs:
+        heapq.heappush(finish, heapq.heappop(finish) + cost)
+    return max(finish)
+
+
+class Window(object):
+    """ A bundle's reports between start_time and end_time
+
+    account_id defaults to the account of the Earwig downloading it.
+    """
+    def __init__(self, bundle_id, start_time, end_time, account_id=None):
+        self.account_id = account_id
+        self.bundle_id = bundle_id
+        self.start_time = start_time
+        self.end_time = end_time
+        self.cluster_ids = []
+        self.done_cluster_ids = set()
+        self.cluster_sizes = {}
+        self.pending = 0
+        self.done_at = None
+
+    def __repr__(self):
+        return '%s@%s' % (self.bundle_id, time.ctime(self.start_time))
+
+
+class Job(object):
+    """ A cluster, or a slice of its window, to download """
+    def __init__(self, window, cluster_id, start_time, end_time, limit,
+                 cost=1):
+        self.window = window
+        self.cluster_id = cluster_id
+        self.start_time = start_time
+        self.end_time = end_time
+        self.limit = limit
+        self.cost = cost
+
+
+class _Drivers(dict):
+    """ Drivers by account id, created on first use """
+    def __init__(self, factory):
+        super(_Drivers, self).__init__()
+        self.factory = factory
+
+    def __missing__(self, account_id):
+        driver = self[account_id] = self.factory(account_id)
+        return driver
+
+
+class _Cluster(object):
+    """ Progress of a cluster downloaded by one or more jobs """
+    def __init__(self, parts=1):
+        self.pending = parts
+        self.seen_ids = set() if parts > 1 else None
+        self.count = 0
+
+
 class Earwig(object):
     def __init__(self, account_id, bundle_id, start_time, end_time,
                  max_clusters=500, max_reports=500, parallelism=1,
-                 headless=False
+                 headless=False, flatten_workers=0, engine='threads',
+                 url=ERRORREPORTS_URL, windows=None, largest_first=True,
+                 split_clusters=True, queue_size=1000, cache=None,
+                 transport=None, stats_only=False, pool=None
                 ):
-        import Queue
-        self.queue = Queue.Queue()
+        self.queue_size = queue_size
+        self.queue = None
+        self.queue_high_water = 0
         self.lock = threading.Lock()
         self.account_id = account_id
         self.bundle_id = bundle_id
         self.start_time = start_time
         self.end_time = end_time
+        if windows is None:
+            windows = [Window(bundle_id, start_time, end_time)]
+        for window in windows:
+            if window.account_id is None:
+                window.account_id = account_id
+        self.windows = windows
         self.max_clusters = max_clusters
         self.max_reports = max_reports
         self.parallelism = parallelism
         self.headless = headless
+        self.flatten_workers = flatten_workers
+        self.largest_first = largest_first
+        self.split_clusters = split_clusters
+        # A pool from the caller outlives the run
+        self.pool = pool
+        self.own_pool = pool is None
+        self.engine = engine
+        self.url = url
+        self.cache = cache
+        self.stats_only = stats_only
+        self.transport = transport or Transport(pool_size=max(10, parallelism))
+        self.loop = None
+        self.flatten = formats.compile_spec(formats.REPORT_SPEC)
+        self.metrics = metrics.shared_metrics()
         self.logger = logging.getLogger('main')
         self.rc = 0
 
     def _yield(self, datum):
-        self.queue.put(datum)
+        """ Hand datum to the consumer, blocking while the queue is full """
+        blocked_at = None
+        while True:
+            try:
+                size = self._put(datum)
+                break
+            except Queue.Full:
+                blocked_at = blocked_at or time.time()
+                if self.terminated:
+                    raise KeyboardInterrupt
+        if blocked_at is not None:
+            self.metrics.thread_time('queue_wait', time.time() - blocked_at)
+        self.metrics.set('queue_depth', size)
+        self.metrics.set_max('queue_high_water', size)
+        if size > self.queue_high_water:
+            self.queue_high_water = size
+            if size == self.queue_size:
+                self.logger.debug("Queue full, waiting for the output")
+
+    def _put(self, datum):
+        """ Put datum on the queue within 0.5s and return the queue size,
+        out of reach of terminate(), as an interrupt landing inside the
+        queue's methods can leave it locked """
+        try:
+            if not self._shield():
+                raise KeyboardInterrupt
+            self.queue.put(datum, timeout=0.5)
+            return self.queue.qsize()
+        finally:
+            self.shielded.discard(threading.current_thread())
+
+    def _shield(self):
+        """ Keep terminate() from interrupting this thread until it leaves
+        self.shielded, returning False if it is terminating """
+        thread = threading.current_thread()
+        try:
+            self.shielded.add(thread)
+            # _stop() may have picked this thread just before
+            while self.interrupting is thread:
+                time.sleep(0.001)
+            _thread_raise(thread, None)
+        except KeyboardInterrupt:
+            pass
+        return not self.terminated
+
+    def _driver(self, account_id, **kwargs):
+        return PlayDriver(account_id, headless=self.headless,
+                          url=self.url, transport=self.transport,
+                          cache=self.cache, **kwargs)
+
+    def _drivers(self, **kwargs):
+        return _Drivers(lambda account_id: self._driver(account_id, **kwargs))
+
+    def _next_job_index(self):
+        with self.lock:
+            job_ix = self.current_job_ix
+            self.current_job_ix += 1
+            return job_ix
+
+    def _job_done(self, job):
+        """ Account for a finished job
+
+        Returns whether its cluster, and then its window, are done.
+        """
+        with self.lock:
+            cluster = self.clusters[job.window, job.cluster_id]
+            cluster.pending -= 1
+            if cluster.pending:
+                return False, False
+            job.window.pending -= 1
+            return True, job.window.pending == 0
 
-    def _next_cluster_index(self):
+    def _accept(self, job, reports):
+        """ Drop reports already fetched by another slice of the cluster, or
+        past max_reports """
         with self.lock:
-            cluster_ix = self.current_cluster_ix
-            self.current_cluster_ix += 1
-            return cluster_ix
+            cluster = self.clusters[job.window, job.cluster_id]
+            if cluster.seen_ids is not None:
+                seen_ids = cluster.seen_ids
+                unseen = []
+                for report in reports:
+                    if report.get('1') not in seen_ids:
+                        seen_ids.add(report.get('1'))
+                        unseen.append(report)
+                reports = unseen
+            reports = reports[:max(0, self.max_reports - cluster.count)]
+            cluster.count += len(reports)
+            return reports
 
     def terminate(self, rc):
         self.logger.error("Terminating: %s", rc)
+        # The first failure sets the exit code
+        self.rc = self.rc or rc
+        self._stop()
+
+    def _stop(self):
+        """ Stop the workers, interrupting them only the first time """
+        # Taken once and never released: a lock held while interrupting
+        # could be left locked by an interrupt landing on its release
+        if not self.stopping.acquire(False):
+            return
         self.terminated = True
+        if self.loop is not None:
+            self.loop.cancel()
         for thread in self.threads:
-            _thread_raise(thread, KeyboardInterrupt)
-        self.rc = rc
+            # The calling thread is already unwinding, and shielded ones
+            # stop by themselves
+            if thread is threading.current_thread():
+                continue
+            # Threads entering _shield() wait for the interrupt, if any
+            self.interrupting = thread
+            try:
+                if thread not in self.shielded:
+                    _thread_raise(thread, KeyboardInterrupt)
+            finally:
+                self.interrupting = None
+
+    def _flatten(self, reports):
+        if self.pool is None:
+            return self.flatten(reports)
+        result = self.pool.apply_async(_flatten_in_worker, (reports,))
+        # Wait with a timeout so terminate() can still interrupt this thread
+        while not result.ready():
+            result.wait(0.1)
+        return result.get()
 
     def _processor(self):
         try:
-            self._processor_impl()
+            try:
+                try:
+                    self._processor_impl()
+                except Exception as e:
+                    # An interrupt landing in logging could leave its lock
+                    # held, and this thread is stopping anyway
+                    self._shield()
+                    self.logger.exception("Exception caught. Terminating...")
+                    self.terminate(3)
+            finally:
+                self._processor_done()
+        # Interrupts from terminate() land anywhere before
+        # _processor_done(), including the handler above
         except KeyboardInterrupt:
             pass
-        except Exception as e:
-            self.logger.exception("Exception caught. Terminating...")
-            self.terminate(3)
+
+    def _processor_done(self):
+        """ Tell the consumer this thread is done, out of reach of
+        terminate() """
+        self._shield()
+        while True:
+            try:
+                self.queue.put(None, timeout=0.5)
+                break
+            except Queue.Full:
+                # The consumer also notices threads ending without one
+                if self.terminated:
+                    break
 
     def _processor_impl(self):
-        driver = PlayDriver(self.account_id, headless=self.headless,
-                            persistence=False)
-        n = len(self.cluster_ids)
+        drivers = self._drivers(persistence=False)
+        n = len(self.jobs)
         while not self.terminated:
-            ix = self._next_cluster_index()
+            ix = self._next_job_index()
             if ix >= n:
                 break
-            cluster_id = self.cluster_ids[ix]
-            reports = driver.get_android_metrics_reports(
-                bundle_id=self.bundle_id, cluster_id=cluster_id,
-                start_time=self.start_time, end_time=self.end_time,
-                limit=self.max_reports)
-            if self.terminated:
-                break
-            self.logger.debug("%s/%s: Cluster %s got %s reports",
-                              ix + 1, n, cluster_id, len(reports))
-            try:
-                flattened = formats.flatten(reports, formats.REPORT_SPEC)
-            except formats.FormatException as e:
-                with open("error.json", "wb") as f:
-                    ujson.dump(e.data, f)
-                if e.leaf:
-                    with open("leaf.json", "wb") as f:
-                        ujson.dump(e.leaf, f)
-                self.logger.error("Format error: %s. File saved at error.json", e)
-                self.terminate(1)
+            job = self.jobs[ix]
+            driver = drivers[job.window.account_id]
+            if not self._process_job(driver, ix, n, job):
                 break
+            cluster_done, window_done = self._job_done(job)
+            if cluster_done:
+                self._yield((job.window, job.cluster_id, None))
+            if window_done:
+                self._yield((job.window, None, None))
+
+    def _process_job(self, driver, ix, n, job):
+        """ Flatten and emit a job page by page, False if terminated """
+        window, cluster_id = job.window, job.cluster_id
+        pages = driver.iter_android_metrics_reports(**self._reports_params(job))
+        count = 0
+        for reports in pages:
+            if self.terminated:
+                return False
+            reports = self._accept(job, reports)
+            count += len(reports)
+            flattened = self._flatten_page(window, cluster_id, reports)
+            if flattened is None:
+                return False
             for report in flattened:
-                self.logger.debug("Saving report %s", report['id'])
-                report['bundleId'] = self.bundle_id
-                report['clusterId'] = cluster_id
-                self._yield(report)
+                self._yield((window, cluster_id, report))
+        self.logger.debug("%s/%s: Cluster %s got %s reports",
+                          ix + 1, n, cluster_id, count)
+        return not self.terminated
 
+    def _reports_params(self, job):
+        return dict(bundle_id=job.window.bundle_id, cluster_id=job.cluster_id,
+                    start_time=job.start_time, end_time=job.end_time,
+                    limit=job.limit, done=lambda: self._cluster_full(job))
 
-    def reports_iterator(self):
-            driver = PlayDriver(self.account_id, headless=self.headless)
-            self.logger.info("Downloading hourly reports for %s",
-                             time.ctime(self.start_time))
-            clusters = driver.list_android_metrics_error_clusters(
-                bundle_id=self.bundle_id, limit=self.max_clusters,
-                start_time=self.start_time, end_time=self.end_time)
-            self.current_cluster_ix = 0
-            self.cluster_ids = [cluster['1'] for cluster in clusters]
-            self.terminated = False
-            self.threads = []
-            for thread_ix in xrange(self.parallelism):
-                name = 'earwig-%s' % thread_ix
-                thread = threading.Thread(target=self._processor, name=name)
-                thread.start()
-                self.threads.append(thread)
-            while any(t.is_alive() for t in self.threads):
+    def _cluster_full(self, job):
+        """ Whether job's cluster already has max_reports reports """
+        with self.lock:
+            cluster = self.clusters[job.window, job.cluster_id]
+            return cluster.count >= self.max_reports
+
+    def _flatten_page(self, window, cluster_id, reports):
+        """ Flatten a page of reports, None on format errors """
+        started_at = time.time()
+        try:
+            flattened = self._flatten(reports)
+        except formats.FormatException as e:
+            with open("error.json", "wb") as f:
+                ujson.dump(e.data, f)
+            if e.leaf:
+                with open("leaf.json", "wb") as f:
+                    ujson.dump(e.leaf, f)
+            self.logger.error("Format error: %s. File saved at error.json", e)
+            self.terminate(1)
+            return None
+        elapsed = time.time() - started_at
+        self.metrics.observe('flatten_seconds', elapsed)
+        self.metrics.thread_time('flatten', elapsed)
+        self.metrics.add_cluster_seconds(cluster_id, elapsed)
+        self.metrics.inc('reports_total', len(flattened))
+        tracing.complete('flatten', started_at, cluster_id=cluster_id,
+                         reports=len(flattened))
+        for report in flattened:
+            self.logger.debug("Saving report %s", report['id'])
+            report['bundleId'] = window.bundle_id
+            report['clusterId'] = cluster_id
+        return flattened
+
+    def _threaded_reports(self):
+        self.queue = Queue.Queue(self.queue_size)
+        self.queue_high_water = 0
+        for thread_ix in xrange(self.parallelism):
+            name = 'earwig-%s' % thread_ix
+            thread = threading.Thread(target=self._processor, name=name)
+            thread.start()
+            self.threads.append(thread)
+        running = len(self.threads)
+        try:
+            while running:
                 try:
-                    yield self.queue.get(timeout=0.1)
+                    # A blocking get() would not see Ctrl-C on Python 2
+                    item = self.queue.get(timeout=0.1)
                 except Queue.Empty:
-                    pass
+                    if any(t.is_alive() for t in self.threads):
+                        continue
+                    # Threads interrupted by terminate() can die without
+                    # handing over their sentinel
+                    while not self.queue.empty():
+                        item = self.queue.get()
+                        if item is not None:
+                            yield item
+                    break
+                if item is None:
+                    running -= 1
+                else:
+                    yield item
+        finally:
+            # Unblock the producers if the consumer stopped early
+            if running:
+                self._stop()
+            self.logger.info("Queue high-water mark: %s of %s items",
+                             self.queue_high_water, self.queue_size)
+
+    def _job_pages(self, driver, job):
+        yield driver.android_metrics_reports_pages(**self._reports_params(job))
+        # Tell the loop this job is finished
+        yield engine.Emit(None)
+
+    def _async_reports(self):
+        drivers = self._drivers(persistence=False)
+        self.loop = engine.AsyncEngine(self.transport.session, self.parallelism)
+        jobs = ((job, self._job_pages(drivers[job.window.account_id], job))
+                for job in self.jobs)
+        try:
+            for job, reports in self.loop.run(jobs):
+                window, cluster_id = job.window, job.cluster_id
+                if reports is None:
+                    cluster_done, window_done = self._job_done(job)
+                    if cluster_done:
+                        yield window, cluster_id, None
+                    if window_done:
+                        yield window, None, None
+                    continue
+                reports = self._accept(job, reports)
+                flattened = self._flatten_page(window, cluster_id, reports)
+                if flattened is None:
+                    break
+                for report in flattened:
+                    yield window, cluster_id, report
+        except Exception:
+            self.logger.exception("Exception caught. Terminating...")
+            self.terminate(3)
+        finally:
+            self.loop = None
+
+    def _run_loop(self, jobs):
+        """ Run coroutine jobs -j at a time, yielding what they emit """
+        self.loop = engine.AsyncEngine(
+            self.transport.session, max(1, min(self.parallelism, len(jobs))))
+        try:
+            for item in self.loop.run(jobs):
+                yield item
+        finally:
+            self.loop = None
+
+    def _list_clusters(self, drivers):
+        with tracing.span('list_clusters', windows=len(self.windows)):
+            self._list_windows_clusters(drivers)
+
+    def _list_windows_clusters(self, drivers):
+        jobs = [(window, drivers[window.account_id]
+                 .android_metrics_error_clusters_pages(
+                    bundle_id=window.bundle_id, limit=self.max_clusters,
+                    start_time=window.start_time, end_time=window.end_time))
+                for window in self.windows]
+        for window, clusters in self._run_loop(jobs):
+            window.cluster_ids += [cluster['1'] for cluster in clusters]
+
+    def _statistics_jobs(self, drivers, pending):
+        """ Coroutines fetching the statistics of (window, cluster ids)
+        pairs, packing as many clusters into each call as the API allows """
+        def statistics(window, cluster_ids):
+            driver = drivers[window.account_id]
+            result = yield driver.android_metrics_cluster_statistics(
+                bundle_id=window.bundle_id, clusters=cluster_ids,
+                start_time=window.start_time, end_time=window.end_time)
+            yield engine.Emit((cluster_ids, result))
+
+        jobs = []
+        batch = CLUSTER_STATISTICS_BATCH
+        for window, cluster_ids in pending:
+            for ix in xrange(0, len(cluster_ids), batch):
+                jobs.append((window, statistics(window, cluster_ids[ix:ix + batch])))
+        return jobs
+
+    def _fetch_cluster_sizes(self, drivers):
+        """ Fetch the size of every scheduled cluster, in batches
+
+        Returns how many sizes were found.
+        """
+        pending = {}
+        for job in self.jobs:
+            pending.setdefault(job.window, []).append(job.cluster_id)
+        jobs = self._statistics_jobs(drivers, pending.iteritems())
+        parsed = 0
+        sample = None
+        with tracing.span('cluster_statistics', batches=len(jobs)):
+            for window, (_, result) in self._run_loop(jobs):
+                sizes = cluster_sizes(result)
+                parsed += len(sizes)
+                sample = sample or result
+                window.cluster_sizes.update(sizes)
+        if jobs and not parsed:
+            # Every cluster would then cost one round trip
+            self.logger.warning("No report counts in cluster statistics, "
+                                "scheduling without them: %.200s",
+                                ujson.dumps(sample))
+        return parsed
+
+    def _statistics(self, drivers):
+        """ Yield (window, cluster_id, summary) for every listed cluster,
+        then (window, None, None) for every window
+
+        Clusters without a report count are summarized with reports None
+        and, as raw, their entry or else the unmatched entries of their
+        batch. If no count is found at all, the windows are not completed.
+        """
+        pending = [(window, [cluster_id for cluster_id in window.cluster_ids
+                             if cluster_id not in window.done_cluster_ids])
+                   for window in self.windows]
+        jobs = self._statistics_jobs(drivers, pending)
+        parsed = missing = 0
+        sample = None
+        with tracing.span('cluster_statistics', batches=len(jobs)):
+            for window, (cluster_ids, result) in self._run_loop(jobs):
+                sizes = cluster_sizes(result)
+                parsed += len(sizes)
+                sample = sample or result
+                entries = {}
+                unmatched = []
+                for entry in result.get('1') or []:
+                    cluster_id = entry.get('1') \
+                        if isinstance(entry, dict) else None
+                    if cluster_id in cluster_ids:
+                        entries[cluster_id] = entry
+                    else:
+                        unmatched.append(entry)
+                for cluster_id in cluster_ids:
+                    entry = entries.get(cluster_id)
+                    summary = dict(
+                        bundleId=window.bundle_id, clusterId=cluster_id,
+                        startTime=window.start_time, endTime=window.end_time,
+                        reports=sizes.get(cluster_id),
+                        breakdowns=dict((k, v) for k, v in
+                                        (entry or {}).iteritems()
+                                        if k not in ('1', '2')))
+                    if summary['reports'] is None:
+                        summary['raw'] = unmatched if entry is None else entry
+                        missing += 1
+                    yield window, cluster_id, summary
+        if jobs and not parsed:
+            self.logger.error("No report counts in cluster statistics, "
+                              "not saving the summaries: %.200s",
+                              ujson.dumps(sample))
+            self.rc = 3
+            return
+        if missing:
+            self.logger.warning("%d clusters without a report count in "
+                                "cluster statistics", missing)
+        for window in self.windows:
+            yield window, None, None
+
+    def _cost(self, window, cluster_id):
+        """ Estimated round trips to download a cluster """
+        size = min(window.cluster_sizes.get(cluster_id, 0), self.max_reports)
+        return max(1, -(-size // REPORTS_PAGE_SIZE))
+
+    def _split(self, job):
+        """ Slice a large cluster's window so workers fetch it concurrently
+
+        Each slice may fetch up to max_reports, as reports can be skewed into
+        one of them. The cluster's total is capped by _accept(), and slices
+        stop paging once it is reached.
+        """
+        window = job.window
+        duration = window.end_time - window.start_time
+        parts = min(self.parallelism, -(-job.cost // SPLIT_ROUND_TRIPS),
+                    duration // MIN_SPLIT_SECONDS)
+        if parts < 2:
+            return [job]
+        bounds = [window.start_time + duration * ix // parts
+                  for ix in xrange(parts + 1)]
+        cost = -(-job.cost // parts)
+        return [Job(window, job.cluster_id, start, end, self.max_reports, cost)
+                for start, end in zip(bounds, bounds[1:])]
+
+    def _schedule(self, drivers):
+        """ Split large clusters and dispatch the largest jobs first
+
+        Returns the estimated makespan in listing order, or None if cluster
+        sizes are unknown.
+        """
+        try:
+            if not self._fetch_cluster_sizes(drivers):
+                return None
+        except Exception:
+            self.logger.warning("Unable to fetch cluster statistics, "
+                                "keeping listing order", exc_info=True)
+            return None
+        for job in self.jobs:
+            job.cost = self._cost(job.window, job.cluster_id)
+        listing = _makespan([job.cost for job in self.jobs], self.parallelism)
+        if self.split_clusters:
+            jobs = []
+            for job in self.jobs:
+                parts = self._split(job)
+                if len(parts) > 1:
+                    self.logger.info("Splitting cluster %s of %s into %s "
+                                     "slices", job.cluster_id, job.window,
+                                     len(parts))
+                    self.clusters[job.window, job.cluster_id] = \
+                        _Cluster(len(parts))
+                jobs += parts
+            self.jobs = jobs
+        if self.largest_first:
+            # sorted() is stable, so equal costs keep listing order
+            self.jobs.sort(key=lambda job: -job.cost)
+        return listing
+
+    def _interleave_bundles(self):
+        """ Share the workers fairly between bundles
+
+        Each next job is taken from the bundle dispatched the fewest round
+        trips so far, so a bundle with a spike of large clusters does not
+        hold every worker while the others wait. Each bundle's jobs keep
+        their order.
+        """
+        queues = collections.OrderedDict()
+        for job in self.jobs:
+            key = job.window.account_id, job.window.bundle_id
+            queues.setdefault(key, collections.deque()).append(job)
+        if len(queues) < 2:
+            return
+        import heapq
+        heap = [(0, ix, queue) for ix, queue in enumerate(queues.itervalues())]
+        jobs = []
+        while heap:
+            cost, ix, queue = heapq.heappop(heap)
+            job = queue.popleft()
+            jobs.append(job)
+            if queue:
+                heapq.heappush(heap, (cost + job.cost, ix, queue))
+        self.jobs = jobs
+
+    def windows_iterator(self):
+        """ Yield (window, cluster_id, report) for each report
+
+        (window, cluster_id, None) follows a cluster's last report, and
+        (window, None, None) a window's last cluster. Clusters in a
+        window's done_cluster_ids are not downloaded again. With
+        stats_only, a summary of each cluster's statistics stands for its
+        reports.
+        """
+        self.terminated = False
+        self.stopping = threading.Lock()
+        self.threads = []
+        # Threads terminate() must not interrupt
+        self.shielded = set()
+        # The thread _stop() is about to interrupt
+        self.interrupting = None
+        drivers = self._drivers()
+        for window in self.windows:
+            self.logger.info("Downloading hourly reports for %s",
+                             time.ctime(window.start_time))
+        self._list_clusters(drivers)
+        if self.stats_only:
+            try:
+                for item in self._statistics(drivers):
+                    yield item
+            finally:
+                self._log_transport()
+            return
+        self.current_job_ix = 0
+        self.jobs = []
+        self.clusters = {}
+        for window in self.windows:
+            cluster_ids = [cluster_id for cluster_id in window.cluster_ids
+                           if cluster_id not in window.done_cluster_ids]
+            if window.done_cluster_ids:
+                self.logger.info("Resuming %s, %s of %s clusters left",
+                                 window, len(cluster_ids),
+                                 len(window.cluster_ids))
+            window.pending = len(cluster_ids)
+            for cluster_id in cluster_ids:
+                self.clusters[window, cluster_id] = _Cluster()
+                self.jobs.append(Job(window, cluster_id, window.start_time,
+                                     window.end_time, self.max_reports))
+        listing = None
+        if self.jobs and self.parallelism > 1 and \
+                (self.largest_first or self.split_clusters):
+            listing = self._schedule(drivers)
+        self._interleave_bundles()
+        if listing is not None:
+            scheduled = _makespan([job.cost for job in self.jobs],
+                                  self.parallelism)
+            self.logger.info("Estimated makespan: %s round trips as "
+                             "scheduled, %s in listing order",
+                             scheduled, listing)
+        for window in self.windows:
+            if not window.pending:
+                yield window, None, None
+        if self.flatten_workers and self.pool is None:
+            # Threads already running, such as the compressor's or a
+            # driver's, may hold locks that stay locked in the forked
+            # workers: the command line forks its pool before starting any
+            self.pool = flatten_pool(self.flatten_workers)
+        if self.engine == 'async':
+            items = self._async_reports()
+        else:
+            items = self._threaded_reports()
+        try:
+            for item in items:
+                yield item
+        finally:
+            items.close()
+            if self.pool is not None and self.own_pool:
+                if self.terminated:
+                    self.pool.terminate()
+                else:
+                    self.pool.close()
+                self.pool.join()
+                self.pool = None
+            self._log_transport()
+
+    def _log_transport(self):
+        stats = self.transport.stats()
+        for k, v in stats.iteritems():
+            self.metrics.set('transport_' + k, v)
+        self.logger.info("%(requests)s requests over %(connections)s "
+                         "connections, %(reused)s reused", stats)
+
+    def reports_iterator(self):
+        for _, _, report in self.windows_iterator():
+            if report is not None:
+                yield report
+
+
+_ISO_TIMESTAMP = re.compile(r'^(\d{4})-(\d\d)-(\d\d)'
+                            r'(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.\d+)?)?)?'
+                            r'(Z|[+-]\d\d:?\d\d)?$')
+
+
+def _iso_timestamp(match):
+    fields = [int(v or 0) for v in match.groups()[:6]]
+    # Raises ValueError on out of range fields, which mktime would roll over
+    parsed = datetime.datetime(*fields)
+    offset = match.group(7)
+    if offset is None:
+        return int(time.mktime(parsed.timetuple()))
+    seconds = calendar.timegm(parsed.timetuple())
+    if offset != 'Z':
+        sign = -1 if offset[0] == '-' else 1
+        digits = offset[1:].replace(':', '')
+        seconds -= sign * (int(digits[:2]) * 3600 + int(digits[2:]) * 60)
+    return seconds
 
 
 def opt_timestamp(s):
+    """ Parse epoch seconds and ISO 8601 natively, anything else with
+    dateparser """
+    s = s.strip()
+    if s.isdigit():
+        return int(s)
+    match = _ISO_TIMESTAMP.match(s)
+    if match:
+        return _iso_timestamp(match)
     import dateparser
-    return int(time.mktime(dateparser.parse(s).timetuple()))
+    parsed = dateparser.parse(s)
+    if parsed is None:
+        raise ValueError(s)
+    return int(time.mktime(parsed.timetuple()))
 
 
 def _previous_hour():
@@ -141,10 +807,330 @@ def _error(msg):
     sys.exit(1)
 
 
-def main():
+def _add_common_arguments(parser, targets=True):
+    parser.add_argument('-j', '--threads', default=1, type=int,
+                        help='set the parallelism, i.e. threads or, with the '
+                        'async engine, concurrent requests (default: 1)')
+    parser.add_argument('-e', '--engine', default='threads',
+                        choices=('threads', 'async'),
+                        help='download clusters on one thread each or on a '
+                        'single event loop (default: threads)')
+    parser.add_argument('-w', '--flatten-workers', default=0, type=int,
+                        help='flatten reports in a pool of this many '
+                        'processes (default: 0, i.e. on the download threads)')
+    parser.add_argument('--queue-size', default=1000, type=int,
+                        help='buffer at most this many reports for the output, '
+                        'pausing downloads when full (default: 1000)')
+    parser.add_argument('-z', '--compress-threads', default=4, type=int,
+                        help='gzip outputs in blocks on this many threads '
+                        '(default: 4)')
+    parser.add_argument('--compress-level', default=6, type=int,
+                        choices=range(1, 10), metavar='{1..9}',
+                        help='gzip compression level (default: 6)')
+    parser.add_argument('--compact', choices=('frames', 'stacks'),
+                        help='write each distinct stack frame, or whole '
+                        'stack, once and refer to it by id')
+    parser.add_argument('--stats-only', action='store_true',
+                        help='write a summary of each cluster, with its '
+                        'report count and breakdowns, instead of its reports')
+    parser.add_argument('--listing-order', action='store_true',
+                        help='download clusters in listing order instead of '
+                        'largest first')
+    parser.add_argument('--no-split', action='store_true',
+                        help='download each cluster on a single worker, even '
+                        'large ones')
+    parser.add_argument('--max-rate', type=float, metavar='N',
+                        help='send at most N requests per second (default: '
+                        'no limit until the first throttle)')
+    parser.add_argument('--endpoint', default=ERRORREPORTS_URL,
+                        help='send requests to this errorreports url, e.g. '
+                        'benchmarks/fakeplay.py')
+    parser.add_argument('--cache', metavar='DIR',
+                        help='keep responses about windows that ended over '
+                        '6 hours ago in this directory and reuse them')
+    parser.add_argument('--cache-ttl', default=30, type=float, metavar='DAYS',
+                        help='expire cached responses after this many days '
+                        '(default: 30)')
+    parser.add_argument('--cache-size', default=1024, type=int, metavar='MB',
+                        help='evict the least recently used responses beyond '
+                        'this size (default: 1024)')
+    parser.add_argument('--replay', action='store_true',
+                        help='answer every request from --cache, failing '
+                        'instead of going to the network')
+    parser.add_argument('--metrics', metavar='PATH',
+                        help='write a JSON summary of the run metrics on exit')
+    parser.add_argument('--prometheus', metavar='PATH',
+                        help='keep a Prometheus textfile of the run metrics '
+                        'up to date')
+    parser.add_argument('--trace', metavar='PATH',
+                        help='record a timeline of the run in Chrome Trace '
+                        'Event format, e.g. for Perfetto')
+    parser.add_argument('-H', '--headless', action='store_true',
+                        help="run in headless mode, i.e. do not use Selenium "
+                        "and expect a valid state file to be present")
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='minimize execution output')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='report more information during execution')
+    if not targets:
+        return
+    parser.add_argument('account_id',
+                        help='the account id to download reports for')
+    parser.add_argument('bundle_ids', metavar='bundle_id', nargs='+',
+                        help='the bundle ids to download reports for, '
+                        'sharing the workers fairly')
+
+
+def _setup_logging(opts):
+    log_level = 10 if opts.verbose else 20 if not opts.quiet else 30
+    logging.basicConfig(format="%(asctime)s [%(threadName)-10s] %(levelname)5s %(name)-8s %(message)s", level=log_level)
+
+
+def _cache(opts):
+    if opts.replay and not opts.cache:
+        _error("--replay requires --cache")
+    if not opts.cache:
+        return None
+    return ResponseCache(opts.cache, ttl=opts.cache_ttl * 86400,
+                         max_bytes=opts.cache_size << 20, replay=opts.replay)
+
+
+def _rate_limit(opts):
+    if opts.max_rate is not None and opts.max_rate <= 0:
+        _error("--max-rate must be positive")
+    if opts.max_rate:
+        ratelimit.shared_limiter().set_max_rate(opts.max_rate)
+
+
+def _earwig(opts, start_time, end_time, windows=None, account_id=None,
+            bundle_id=None, transport=None, pool=None):
+    _rate_limit(opts)
+    return Earwig(account_id or opts.account_id,
+                  bundle_id or opts.bundle_ids[0],
+                  start_time, end_time,
+                  parallelism=opts.threads, headless=opts.headless,
+                  flatten_workers=opts.flatten_workers, engine=opts.engine,
+                  windows=windows, largest_first=not opts.listing_order,
+                  split_clusters=not opts.no_split,
+                  queue_size=opts.queue_size, url=opts.endpoint,
+                  cache=_cache(opts), transport=transport,
+                  stats_only=opts.stats_only, pool=pool)
+
+
+def _compressor(opts):
+    return Compressor(opts.compress_level, opts.compress_threads)
+
+
+def _flatten_pool(opts):
+    """ Fork the -w pool, before the compressor, the listing or anything
+    else starts a thread """
+    if not opts.flatten_workers:
+        return None
+    return flatten_pool(opts.flatten_workers)
+
+
+def _check_output(path, stats_only=False):
+    """ Exit unless _output() can write path, which may be a pattern """
+    if not columnar.is_columnar(path):
+        return
+    if stats_only:
+        _error('--stats-only writes JSON, not %s' % path)
+    try:
+        import pyarrow
+    except ImportError:
+        _error('pyarrow is required to write %s' % path)
+
+
+def _output(path, window, compressor=None, compact=None, stats_only=False):
+    """ Open path for window, marking the clusters it already holds done """
+    if path == '-':
+        return Output(path, compact=compact)
+    _check_output(path, stats_only)
+    if stats_only:
+        return Output(path, compressor)
+    if columnar.is_columnar(path):
+        return columnar.ColumnarOutput(path)
+    output = SegmentedOutput(path, window, compressor, compact)
+    window.done_cluster_ids = output.completed_clusters()
+    return output
+
+
+def sink(earwig, outputs, compressor=None):
+    """ Write each window's reports to outputs[window]
+
+    Outputs are committed as their window completes, and aborted if the
+    run ends before that. Their shared compressor is closed at the end.
+    Returns the number of reports written.
+    """
+    logger = logging.getLogger('main')
+    saved = 'clusters summarized' if earwig.stats_only else 'reports saved'
+    outputs = dict(outputs)
+    # Windows may share an output, such as stdout
+    counts = collections.Counter()
+    n = 0
+    try:
+        for window, cluster_id, report in earwig.windows_iterator():
+            output = outputs[window]
+            if cluster_id is None:
+                outputs.pop(window).commit()
+                window.done_at = time.time()
+                logger.info("%d %s to %s", counts[window], saved,
+                            output.path)
+                continue
+            if report is None:
+                output.cluster_done(cluster_id)
+                continue
+            started_at = time.time()
+            output.write(cluster_id, report)
+            counts[window] += 1
+            earwig.metrics.thread_time('write', time.time() - started_at)
+            tracing.complete('write', started_at, cluster_id=cluster_id)
+            n += 1
+            if not n % 100:
+                logger.info("%d reports processed", n)
+    except KeyboardInterrupt:
+        earwig.terminate(2)
+    finally:
+        for output in outputs.itervalues():
+            output.abort()
+        if compressor is not None:
+            compressor.close()
+            earwig.metrics.set('output_bytes', compressor.raw_bytes)
+            earwig.metrics.set('compressed_bytes', compressor.compressed_bytes)
+            if compressor.raw_bytes:
+                logger.info("Compressed %(raw_mb).1f MB to "
+                            "%(compressed_mb).1f MB at %(mb_per_s).1f MB/s "
+                            "per thread",
+                            compressor.stats())
+    return n
+
+
+def _run(opts, earwig, outputs, compressor, pool=None):
+    """ Sink earwig into outputs and exit, writing metrics and traces if
+    asked to, and closing pool """
+    registry = earwig.metrics
+    textfile = None
+    if opts.prometheus:
+        textfile = metrics.TextfileWriter(registry, opts.prometheus)
+    if opts.trace:
+        tracing.start()
+    try:
+        sink(earwig, outputs, compressor)
+    finally:
+        if opts.trace:
+            tracing.stop(opts.trace)
+        if textfile is not None:
+            textfile.close()
+        if opts.metrics:
+            registry.write_json(opts.metrics)
+        if pool is not None:
+            if earwig.rc:
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+    sys.exit(earwig.rc)
+
+
+DEFAULT_OUTPUT = 'output/%Y%m%d/%H.json.gz'
+# The default with several bundles
+DEFAULT_BUNDLES_OUTPUT = 'output/{bundle_id}/%Y%m%d/%H.json.gz'
+# The defaults with --stats-only
+DEFAULT_STATS_OUTPUT = 'output/%Y%m%d/%H.stats.json.gz'
+DEFAULT_BUNDLES_STATS_OUTPUT = 'output/{bundle_id}/%Y%m%d/%H.stats.json.gz'
+
+
+def _output_pattern(opts):
+    """ The output pattern, which must tell several bundles apart """
+    if len(opts.bundle_ids) == 1:
+        return opts.output or (DEFAULT_STATS_OUTPUT if opts.stats_only
+                               else DEFAULT_OUTPUT)
+    if not opts.output:
+        return DEFAULT_BUNDLES_STATS_OUTPUT if opts.stats_only \
+            else DEFAULT_BUNDLES_OUTPUT
+    if opts.output != '-' and '{bundle_id}' not in opts.output:
+        _error("--output must contain {bundle_id} with several bundles")
+    return opts.output
+
+
+def _substitute(pattern, account_id, bundle_id):
+    """ Substitute {account_id} and {bundle_id}, leaving other braces """
+    return pattern.replace('{account_id}', str(account_id)) \
+        .replace('{bundle_id}', str(bundle_id))
+
+
+def output_path(pattern, start_time, account_id, bundle_id):
+    """ Substitute {account_id}, {bundle_id} and strftime fields """
+    pattern = _substitute(pattern, account_id, bundle_id)
+    return time.strftime(pattern, time.localtime(start_time))
+
+
+def backfill(argv):
     import argparse
     import os
 
+    parser = argparse.ArgumentParser(
+        prog='earwig backfill',
+        description="Download Google Play ANR reports hour by hour")
+    parser.add_argument('-f', '--from', dest='from_time', type=opt_timestamp,
+                        required=True, help='specify backfill start time')
+    parser.add_argument('-t', '--to', dest='to_time', type=opt_timestamp,
+                        required=True, help='specify backfill end time')
+    parser.add_argument('-o', '--output',
+                        help='specify the strftime pattern of output '
+                        'filenames, where {bundle_id} is substituted '
+                        '(default: %s, or %s with several bundles, and '
+                        '.stats.json.gz with --stats-only)' % (
+                            DEFAULT_OUTPUT.replace('%', '%%'),
+                            DEFAULT_BUNDLES_OUTPUT.replace('%', '%%')))
+    _add_common_arguments(parser)
+
+    opts = parser.parse_args(argv)
+    _setup_logging(opts)
+    logger = logging.getLogger('main')
+
+    pattern = _output_pattern(opts)
+    start_time = _truncate_to_hour(opts.from_time)
+    if pattern != '-' and start_time + 3600 < opts.to_time and \
+            output_path(pattern, start_time, opts.account_id,
+                        opts.bundle_ids[0]) == \
+            output_path(pattern, start_time + 3600, opts.account_id,
+                        opts.bundle_ids[0]):
+        _error("--output must differ for every hour, such as with %H")
+    pool = _flatten_pool(opts)
+    compressor = _compressor(opts)
+    outputs = {}
+    windows = []
+    for hour in xrange(start_time, opts.to_time, 3600):
+        for bundle_id in opts.bundle_ids:
+            path = output_path(pattern, hour, opts.account_id, bundle_id)
+            if os.path.exists(path):
+                logger.info("Skipping %s, already downloaded", path)
+                continue
+            window = Window(bundle_id, hour, hour + 3600)
+            outputs[window] = _output(path, window, compressor, opts.compact,
+                                      opts.stats_only)
+            windows.append(window)
+    if not windows:
+        compressor.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+        sys.exit(0)
+
+    wig = _earwig(opts, windows[0].start_time, windows[-1].end_time, windows,
+                  pool=pool)
+    _run(opts, wig, outputs, compressor, pool)
+
+
+def main():
+    import argparse
+
+    if sys.argv[1:2] == ['backfill']:
+        backfill(sys.argv[2:])
+    if sys.argv[1:2] == ['serve']:
+        import serve
+        serve.serve(sys.argv[2:])
 
     parser = argparse.ArgumentParser(description="Download Google Play ANR reports")
     parser.add_argument('-f', '--from', dest='from_time', type=opt_timestamp,
@@ -156,66 +1142,51 @@ def main():
                         help='specify time period to download, in seconds '
                         '(defaults to 1 hour)')
     parser.add_argument('-o', '--output',
-                        help='specify the output filename '
-                        '(defaults to output/YYYYMMDD/HH.json.gz)')
-    parser.add_argument('-j', '--threads', default=1, type=int,
-                        help='set the parallelism (default: 1)')
-    parser.add_argument('-H', '--headless', action='store_true',
-                        help="run in headless mode, i.e. do not use Selenium "
-                        "and expect a valid state file to be present")
-    parser.add_argument('-q', '--quiet', action='store_true',
-                        help='minimize execution output')
-    parser.add_argument('-v', '--verbose', action='store_true',
-                        help='report more information during execution')
-    parser.add_argument('account_id',
-                        help='the account id to download reports for')
-    parser.add_argument('bundle_id',
-                        help='the bundle id to download reports for')
+                        help='specify the output filename, where {bundle_id} '
+                        'is substituted (defaults to output/YYYYMMDD/HH.json.gz, '
+                        'or output/BUNDLE_ID/YYYYMMDD/HH.json.gz with several '
+                        'bundles, and .stats.json.gz with --stats-only)')
+    _add_common_arguments(parser)
 
     opts = parser.parse_args(sys.argv[1:])
 
     if opts.to_time and opts.interval:
         _error("only one of --to and --interval may be specified")
 
-    fmt = 'output/%Y%m%d/%H.json.gz'
-
     interval = opts.interval or 3600
     start_time = opts.from_time or _previous_hour()
     end_time = opts.to_time or start_time + interval
-    output_path = opts.output or time.strftime(fmt, time.localtime(start_time))
-
-    if output_path != '-':
-        subdir, _ = os.path.split(output_path)
-        if subdir and not os.path.exists(subdir):
-            os.makedirs(subdir)
-        if not os.path.isdir(subdir):
-            _error('%s is not a directory' % subdir)
-
-    log_level = 10 if opts.verbose else 20 if not opts.quiet else 30
-    logging.basicConfig(format="%(asctime)s [%(threadName)-10s] %(levelname)5s %(name)-8s %(message)s", level=log_level)
-
-    wig = Earwig(opts.account_id, opts.bundle_id, start_time, end_time,
-                 parallelism=opts.threads, headless=opts.headless)
-
-    def sink(earwig, fp):
-        try:
-            logger = logging.getLogger('main')
-            ix = 0
-            for ix, report in enumerate(earwig.reports_iterator()):
-                if ix and not ix % 100:
-                    logger.info("%d reports processed", ix)
-                ujson.dump(report, fp)
-                fp.write('\n')
-            logger.info("%d reports saved to %s", ix, output_path)
-        except KeyboardInterrupt:
-            earwig.terminate(2)
+    pattern = _output_pattern(opts)
+    paths = []
+    for bundle_id in opts.bundle_ids:
+        if opts.output:
+            path = _substitute(pattern, opts.account_id, bundle_id)
+        else:
+            path = output_path(pattern, start_time, opts.account_id, bundle_id)
+        if path != '-':
+            try:
+                makedirs_for(path)
+            except (IOError, OSError) as e:
+                _error(str(e))
+        paths.append(path)
 
-    if output_path == '-':
-        sink(wig, sys.stdout)
-    else:
-        import gzip
-        open_fn = gzip.open if output_path.endswith('.gz') else open
-        with open_fn(output_path, 'wb') as output:
-            sink(wig, output)
+    _setup_logging(opts)
 
-    sys.exit(wig.rc)
+    pool = _flatten_pool(opts)
+    compressor = _compressor(opts)
+    outputs = {}
+    windows = []
+    stdout = None
+    for bundle_id, path in zip(opts.bundle_ids, paths):
+        window = Window(bundle_id, start_time, end_time)
+        if path == '-':
+            # Bundles share stdout, whose reports carry their bundleId
+            stdout = stdout or _output(
+                path, window, compact=None if opts.stats_only else opts.compact)
+            outputs[window] = stdout
+        else:
+            outputs[window] = _output(path, window, compressor, opts.compact,
+                                      opts.stats_only)
+        windows.append(window)
+    wig = _earwig(opts, start_time, end_time, windows, pool=pool)
+    _run(opts, wig, outputs, compressor, pool)
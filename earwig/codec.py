@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+import json
+import ujson
+
+
+class JsonCodec(object):
+    """ The standard library json module, as used by requests """
+    name = 'json'
+
+    def dumps(self, data):
+        return json.dumps(data)
+
+    def loads(self, content):
+        return json.loads(content.decode('utf-8'))
+
+
+class UjsonCodec(object):
+    """ ujson, decoding response bytes without a text copy
+
+    Integers ujson cannot represent fall back to the json module.
+    """
+    name = 'ujson'
+
+    def dumps(self, data):
+        return ujson.dumps(data)
+
+    def loads(self, content):
+        try:
+            return ujson.loads(content)
+        except ValueError:
+            return json.loads(content)
+
+
+CODECS = dict((codec.name, codec) for codec in (JsonCodec(), UjsonCodec()))
+DEFAULT_CODEC = CODECS['ujson']
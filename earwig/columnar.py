@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+import formats
+import os
+import ujson
+
+from output import makedirs_for
+
+
+# Flattened keys holding lists, stored in child tables
+LISTS = ('threads', 'stackTrace')
+EXTENSIONS = ('.parquet', '.arrow')
+
+
+def is_columnar(path):
+    return path.endswith(EXTENSIONS)
+
+
+def _str(v):
+    if v is None or isinstance(v, basestring):
+        return v
+    return ujson.dumps(v)
+
+
+def _int(v):
+    return None if v is None else int(v)
+
+
+class _Table(object):
+    """ Columns of one table, buffered until the next row group """
+    def __init__(self, pa, path, fmt, columns, keys, row_group_size):
+        self.row_group_size = row_group_size
+        self.tmp_path = path + '.part'
+        self.path = path
+        self.fmt = fmt
+        self.names = [name for name, _ in keys + columns]
+        self.converters = []
+        fields = []
+        for name, type_ in keys + columns:
+            if type_ == 'int':
+                pa_type, converter = pa.int64(), _int
+            else:
+                pa_type, converter = pa.string(), _str
+            fields.append(pa.field(name, pa_type))
+            self.converters.append(converter)
+        self.schema = pa.schema(fields)
+        self.pa = pa
+        self.writer = None
+        self._reset()
+
+    def _reset(self):
+        self.buffer = [[] for _ in self.names]
+
+    def append(self, keys, row):
+        values = list(keys) + [row.get(name)
+                               for name in self.names[len(keys):]]
+        for column, converter, value in zip(self.buffer, self.converters,
+                                            values):
+            column.append(converter(value))
+        if len(self.buffer[0]) >= self.row_group_size:
+            self.flush()
+
+    def _open(self):
+        if self.fmt == '.parquet':
+            import pyarrow.parquet
+            return pyarrow.parquet.ParquetWriter(self.tmp_path, self.schema)
+        self.sink = self.pa.OSFile(self.tmp_path, 'wb')
+        return self.pa.RecordBatchFileWriter(self.sink, self.schema)
+
+    def flush(self):
+        """ Write the buffered rows as a row group """
+        if self.writer is None:
+            self.writer = self._open()
+        if not self.buffer[0]:
+            return
+        arrays = [self.pa.array(column, type=field.type)
+                  for column, field in zip(self.buffer, self.schema)]
+        self.writer.write_table(
+            self.pa.Table.from_arrays(arrays, schema=self.schema))
+        self._reset()
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        if self.fmt != '.parquet':
+            self.sink.close()
+        os.rename(self.tmp_path, self.path)
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.close()
+            if self.fmt != '.parquet':
+                self.sink.close()
+            os.unlink(self.tmp_path)
+
+
+class ColumnarOutput(object):
+    """ Reports as typed columns, in Parquet (.parquet) or Arrow IPC (.arrow)
+
+    Columns are derived from formats.REPORT_SPEC, as integers for its 'i_'
+    fields and strings otherwise, after the bundleId and clusterId every
+    report carries. Threads and their stack
+    frames go to child tables next to path, foo.threads.parquet and
+    foo.frames.parquet, keyed by reportId, threadIndex and frameIndex.
+    Each table is written in row groups of `row_group_size` rows, so memory
+    stays bounded. Requires pyarrow.
+    """
+    def __init__(self, path, row_group_size=50000, spec=formats.REPORT_SPEC):
+        import pyarrow
+        self.path = path
+        self.count = 0
+        makedirs_for(path)
+        base, fmt = os.path.splitext(path)
+        columns, children = formats.spec_columns(spec, LISTS)
+        thread_columns, thread_children = children['threads']
+        frame_columns, _ = thread_children['stackTrace']
+        report_id = ('reportId', 'str')
+        thread_ix = ('threadIndex', 'int')
+        self.reports = _Table(pyarrow, path, fmt, columns,
+                              [('bundleId', 'str'), ('clusterId', 'str')],
+                              row_group_size)
+        self.threads = _Table(pyarrow, base + '.threads' + fmt, fmt,
+                              thread_columns, [report_id, thread_ix],
+                              row_group_size)
+        self.frames = _Table(pyarrow, base + '.frames' + fmt, fmt,
+                             frame_columns,
+                             [report_id, thread_ix, ('frameIndex', 'int')],
+                             row_group_size)
+        self.tables = (self.reports, self.threads, self.frames)
+
+    def write(self, cluster_id, report):
+        report_id = report.get('id')
+        self.reports.append((report.get('bundleId'), cluster_id), report)
+        for thread_ix, thread in enumerate(report.get('threads') or ()):
+            self.threads.append((report_id, thread_ix), thread)
+            for frame_ix, frame in enumerate(thread.get('stackTrace') or ()):
+                self.frames.append((report_id, thread_ix, frame_ix), frame)
+        self.count += 1
+
+    def cluster_done(self, cluster_id):
+        pass
+
+    def commit(self):
+        for table in self.tables:
+            table.close()
+
+    def abort(self):
+        for table in self.tables:
+            table.abort()
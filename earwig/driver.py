@@ -1,27 +1,45 @@
 #!/usr/bin/env python
+import atexit
+import contextlib
+import fcntl
 import json
 import logging
 import os
 import re
 import requests
 import sys
+import threading
 import time
 import ujson
 
-from selenium.webdriver.support.ui import WebDriverWait
+import codec as codec_
+import engine
+import metrics as metrics_
+import ratelimit
+import tracing
+import transport as transport_
+from engine import Emit, Request, Return, Sleep
+from output import save_json
 
 
 ERR_RETRY_LIMIT = 1
 ERR_HTTP = 2
 ERR_XSRF = 3
 ERR_CAPTCHA = 4
+ERR_CACHE_MISS = 5
+ERR_AUTH = 6
+
+# Failures a refresh of the credentials may fix
+AUTH_ERRORS = (ERR_XSRF, ERR_AUTH)
 
 
 _ERROR_MESSAGES = {
     ERR_RETRY_LIMIT: 'Retry limit exceeded',
     ERR_HTTP: 'HTTP error',
     ERR_XSRF: 'XSRF missing',
-    ERR_CAPTCHA: 'Received captcha'
+    ERR_CAPTCHA: 'Received captcha',
+    ERR_CACHE_MISS: 'Not in the response cache',
+    ERR_AUTH: 'Not authenticated'
 }
 
 
@@ -61,6 +79,7 @@ def element(browser, field_id, timeout=10):
     from selenium.common.exceptions import TimeoutException
     from selenium.webdriver.common.by import By
     from selenium.webdriver.support import expected_conditions as ec
+    from selenium.webdriver.support.ui import WebDriverWait
     wait = WebDriverWait(browser, timeout)
     try:
         return wait.until(ec.element_to_be_clickable((By.ID, field_id)))
@@ -73,6 +92,7 @@ def element(browser, field_id, timeout=10):
 def fetch_cookies():
     from selenium import webdriver
     from selenium.webdriver.common.keys import Keys
+    from selenium.webdriver.support.ui import WebDriverWait
 
     user, password = get_credentials()
 
@@ -135,9 +155,20 @@ def _load_json(path, default=None):
     except IOError:
         return default
 
-def _save_json(path, data):
-    with open(path, 'wb') as f:
-        ujson.dump(data, f, indent=2, sort_keys=True)
+
+@contextlib.contextmanager
+def _file_lock(path, operation=fcntl.LOCK_EX):
+    """ Hold a lock on path.lock, serializing earwig processes on this host """
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        yield
+        return
+    with open(path + '.lock', 'a') as f:
+        fcntl.flock(f, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
 
 
 def _interval(start_time, interval):
@@ -152,37 +183,82 @@ def _interval(start_time, interval):
 ERROR_CRASH = 1
 ERROR_ANR = 2
 
+ERRORREPORTS_URL = 'https://play.google.com/apps/publish/errorreports'
+
+
+# Clusters per getAndroidMetricsClusterStatistics call
+CLUSTER_STATISTICS_BATCH = 50
+
+# Reports per getAndroidMetricsReports call
+REPORTS_PAGE_SIZE = 10
+
+
+def cluster_sizes(statistics):
+    """ Map cluster ids to report counts in cluster statistics
+
+    Each entry of the result's '1' list is expected to carry the cluster id
+    in '1' and its report count in '2'. Entries that do not are skipped.
+    This layout has only been checked against benchmarks/fakeplay.py.
+    """
+    sizes = {}
+    for entry in statistics.get('1') or []:
+        try:
+            sizes[entry['1']] = int(entry['2'])
+        except (KeyError, TypeError, ValueError):
+            pass
+    return sizes
+
 
 class PlayDriver(object):
     STATE_PATH = os.path.expanduser('~/.earwig/state.json')
 
-    def __init__(self, account_id, persistence=True, headless=False):
+    def __init__(self, account_id, persistence=True, headless=False,
+                 url=ERRORREPORTS_URL, rate_limiter=None, transport=None,
+                 metrics=None, cache=None, codec=None):
         self.logger = logging.getLogger('driver')
-        self.session = requests.Session()
-        self.state = DriverState(self.STATE_PATH)
+        self.url = url
+        self.rate_limiter = rate_limiter or ratelimit.shared_limiter()
+        self.metrics = metrics or metrics_.shared_metrics()
+        self.transport = transport or transport_.Transport()
+        self.cache = cache
+        self.codec = codec or codec_.DEFAULT_CODEC
+        self.session = self.transport.session
+        self.credentials = Credentials.shared(self.STATE_PATH)
+        self.state = self.credentials.state
         self.account_id = account_id
         self.persistence = persistence
         self.headless = headless
 
-    def _paginate(self, cmd, params, limit, page_size):
-        rv = []
+    def _pages(self, cmd, params, limit, page_size, cluster_id=None,
+               end_time=None, done=None):
+        """ Coroutine emitting each page of entries as it is fetched
+
+        done, if given, is called before fetching each further page, and
+        stops the paging when it returns True.
+        """
         offset = None
-        while limit:
+        while limit and not (done and done()):
             n = min(page_size, limit)
-            data = self._execute(cmd, params(offset, n))
+            data = yield self._execute_co(cmd, params(offset, n), cluster_id,
+                                          end_time)
             entries = data.get('1', [])
             offset = data.get('2')
-            rv += entries
             limit -= len(entries)
+            yield Emit(entries)
             if offset is None:
                 break
+
+    def _paginate(self, pages):
+        rv = []
+        for entries in pages:
+            rv += entries
         return rv
 
-    def list_android_metrics_error_clusters(self, bundle_id,
-                                            start_time, end_time, versions=None,
-                                            limit=25, android_versions=None,
-                                            show_hidden=False, kind=ERROR_ANR,
-                                            installed_from_play=False):
+    def android_metrics_error_clusters_pages(self, bundle_id,
+                                             start_time, end_time, versions=None,
+                                             limit=25, android_versions=None,
+                                             show_hidden=False, kind=ERROR_ANR,
+                                             installed_from_play=False):
         def params(offset, limit):
             return f(bundle_id, f(str(start_time)), f(str(end_time)),
                      f(versions,
@@ -191,107 +267,320 @@ class PlayDriver(object):
                        [3, 1] if installed_from_play else None),
                      None, limit, offset)
 
-        return self._paginate('listAndroidMetricsErrorClusters', params, limit, 50)
+        return self._pages('listAndroidMetricsErrorClusters', params, limit, 50,
+                           end_time=end_time)
 
-    def get_android_metrics_reports(self, bundle_id, cluster_id,
-                                    start_time, end_time,
-                                    versions=None, limit=5,
-                                    android_versions=None,
-                                    installed_from_play=False):
+    def iter_android_metrics_error_clusters(self, *args, **kwargs):
+        """ Yield pages of error clusters as they are fetched """
+        return engine.iterate(
+            self.android_metrics_error_clusters_pages(*args, **kwargs),
+            self.session)
+
+    def list_android_metrics_error_clusters(self, *args, **kwargs):
+        return self._paginate(
+            self.iter_android_metrics_error_clusters(*args, **kwargs))
+
+    def android_metrics_reports_pages(self, bundle_id, cluster_id,
+                                      start_time, end_time,
+                                      versions=None, limit=5,
+                                      android_versions=None,
+                                      installed_from_play=False, done=None):
         def params(offset, limit):
             return f(bundle_id, cluster_id, f(str(start_time)), f(str(end_time)),
                      limit, offset, [3, 1] if installed_from_play else None,
                      versions, android_versions)
 
-        return self._paginate('getAndroidMetricsReports', params, limit, 10)
-
-    def get_android_metrics_cluster_statistics(self, bundle_id, clusters,
-                                               start_time, end_time,
-                                               versions=None,
-                                               android_versions=None,
-                                               installed_from_play=False
-                                              ):
+        return self._pages('getAndroidMetricsReports', params, limit,
+                           REPORTS_PAGE_SIZE, cluster_id, end_time, done)
+
+    def iter_android_metrics_reports(self, *args, **kwargs):
+        """ Yield pages of reports as they are fetched """
+        return engine.iterate(
+            self.android_metrics_reports_pages(*args, **kwargs), self.session)
+
+    def get_android_metrics_reports(self, *args, **kwargs):
+        return self._paginate(
+            self.iter_android_metrics_reports(*args, **kwargs))
+
+    def android_metrics_cluster_statistics(self, bundle_id, clusters,
+                                           start_time, end_time,
+                                           versions=None,
+                                           android_versions=None,
+                                           installed_from_play=False
+                                          ):
+        """ Coroutine returning the statistics of a batch of clusters """
         data = f(bundle_id, f(str(start_time)), f(str(end_time)), clusters, f(1, 1, 1),
                  f(versions, None, None, android_versions, None,
                    [3, 1] if installed_from_play else None
                   ))
 
         CMD = 'getAndroidMetricsClusterStatistics'
-        return self._execute(CMD, data)
+        return self._execute_co(CMD, data, end_time=end_time)
 
-    def _execute(self, cmd, cmd_params):
-        URL = 'https://play.google.com/apps/publish/errorreports'
+    def get_android_metrics_cluster_statistics(self, *args, **kwargs):
+        return engine.call(
+            self.android_metrics_cluster_statistics(*args, **kwargs),
+            self.session)
 
-        self._build_state()
+    def _execute(self, cmd, cmd_params):
+        return engine.call(self._execute_co(cmd, cmd_params), self.session)
+
+    def _cache_for(self, end_time):
+        """ The response cache, if results up to end_time may use it """
+        cache = self.cache
+        if cache is None or end_time is None:
+            return None
+        if cache.replay or cache.is_closed(end_time):
+            return cache
+        return None
+
+    def _execute_co(self, cmd, cmd_params, cluster_id=None, end_time=None):
+        """ Coroutine returning the result of an errorreports command
+
+        Commands about windows ending at end_time go through the response
+        cache, if any.
+        """
+        trace_id = tracing.begin('execute', cmd=cmd, cluster_id=cluster_id)
+        try:
+            cache = self._cache_for(end_time)
+            result = None
+            if cache is not None:
+                result = cache.get(self.account_id, cmd, cmd_params)
+                self.metrics.inc('cache_requests_total', cmd=cmd,
+                                 result='miss' if result is None else 'hit')
+            if result is None:
+                if self.cache is not None and self.cache.replay:
+                    raise DriverException(ERR_CACHE_MISS, response=cmd)
+                result = yield self._send_co(cmd, cmd_params, trace_id)
+                if cache is not None:
+                    cache.put(self.account_id, cmd, cmd_params, result)
+        finally:
+            tracing.end('execute', trace_id)
+        yield Return(result)
+
+    def _response(self, r):
+        """ The decoded response of r, or a DriverException """
+        if r.status_code != 200:
+            if 'captcha' in r.text:
+                raise DriverException(ERR_CAPTCHA, response=r)
+            if r.status_code in (401, 403):
+                raise DriverException(ERR_AUTH, response=r)
+            raise DriverException(ERR_HTTP, response=r)
+        try:
+            response = self.codec.loads(r.content)
+        except ValueError:
+            # Most likely a login page
+            raise DriverException(ERR_AUTH, response=r)
+        if response.get('error') is None and not response.get('xsrf'):
+            raise DriverException(ERR_XSRF, response=r)
+        return response
+
+    def _refresh_co(self, generation):
+        """ Coroutine waiting until credentials of generation are replaced """
+        credentials = self.credentials
+        credentials.refresh(generation, self.headless)
+        waited_at = time.time()
+        while credentials.is_refreshing(generation):
+            yield Sleep(Credentials.POLL_INTERVAL)
+        self.metrics.inc('credentials_wait_seconds_total',
+                         time.time() - waited_at)
+        if credentials.generation == generation:
+            raise credentials.error
+
+    def _send_co(self, cmd, cmd_params, trace_id=None):
+        state = self.state
+        codec = self.codec
         params = dict(account=self.account_id)
-        headers = {
-            'X-GWT-Permutation': self.state.gwt,
-            'Content-Type': 'application/javascript; charset=UTF-8'
-        }
-        data = {
-            'method': cmd,
-            'params': ujson.dumps(cmd_params),
-            'xsrf': self.state.xsrf
-        }
+        # The command parameters are a JSON string inside the JSON body
+        encoded_params = codec.dumps(cmd_params)
 
         MAX_RETRIES = 10
-        pause = 30
+        limiter = self.rate_limiter
+        metrics = self.metrics
         for attempt in xrange(MAX_RETRIES):
-            r = self.session.post(URL, params=params, headers=headers,
-                                  cookies=self.state.cookies, json=data)
+            generation = self.credentials.generation
+            if not state.is_valid:
+                yield self._refresh_co(generation)
+                generation = self.credentials.generation
+            # Read before the token, so that a race can only make the
+            # response look staler than it is
+            version = state.version
+            headers = {
+                'X-GWT-Permutation': state.gwt,
+                'Content-Type': 'application/javascript; charset=UTF-8'
+            }
+            body = codec.dumps({
+                'method': cmd,
+                'params': encoded_params,
+                'xsrf': state.xsrf
+            })
+            delay = limiter.reserve()
+            if delay > 0:
+                metrics.inc('wait_seconds_total', delay, cmd=cmd)
+                sleep_id = tracing.begin('sleep', trace_id, seconds=delay,
+                                         attempt=attempt)
+                yield Sleep(delay)
+                tracing.end('sleep', sleep_id)
+            issued_at = time.time()
+            r = yield Request(self.url, params=params, headers=headers,
+                              cookies=state.cookies, data=body)
+            metrics.observe('request_seconds', time.time() - issued_at,
+                            cmd=cmd)
+            metrics.inc('requests_total', cmd=cmd, status=r.status_code)
+            metrics.inc('response_bytes_total', len(r.content), cmd=cmd)
             sc = r.headers.get('set-cookie', '')
             if 'HSID=' in sc or 'SID=' in sc:
                 self.logger.warn("Set-Cookie: %s", sc)
-            if r.status_code != 200:
-                if 'captcha' in self.text:
-                    raise DriverException(ERR_CAPTCHA, response=r)
-                raise DriverException(ERR_HTTP, response=r)
-            response = r.json()
+            try:
+                response = self._response(r)
+            except DriverException as e:
+                if e.code not in AUTH_ERRORS or attempt == MAX_RETRIES - 1:
+                    raise
+                if state.version != version or \
+                        self.credentials.generation != generation:
+                    # Sent with a token since replaced, retry with the new one
+                    metrics.inc('stale_token_retries_total', cmd=cmd)
+                    continue
+                # Wait for fresh credentials, refreshed once for every
+                # request rejected with the same ones, and retry
+                self.logger.warn("%s. Refreshing credentials",
+                                 _ERROR_MESSAGES[e.code])
+                yield self._refresh_co(generation)
+                continue
             error = response.get('error')
             if error is None:
+                limiter.on_success()
                 break
             if attempt == MAX_RETRIES - 1:
                 raise DriverException(ERR_RETRY_LIMIT, response=r)
             code = error['code']
             if code != 6800004:
                 raise DriverException(code, response=r)
-            self.logger.warn("Error 6800004. Retrying after %s seconds", pause)
-            time.sleep(pause)
-            pause *= 1.5
-
-        xsrf = response.get('xsrf')
-        if not xsrf:
-            raise DriverException(ERR_XSRF, response=r)
-        self.state.xsrf = response['xsrf']
-        if self.persistence:
-            self.state.save()
-        return response['result']
-
-    def _build_state(self):
+            pause = limiter.on_throttle(issued_at)
+            metrics.inc('retries_total', cmd=cmd)
+            self.logger.warn("Error 6800004. Retrying after %.1f seconds "
+                             "at %.2f requests/s", pause, limiter.rate)
+        else:
+            raise DriverException(ERR_RETRY_LIMIT, response=r)
+
+        state.rotate_xsrf(response['xsrf'], version)
+        yield Return(response['result'])
+
+
+class Credentials(object):
+    """ Owns the DriverState of a path, and refreshes it for every driver
+
+    A driver failing for lack of valid credentials asks for a refresh of
+    the generation it sent, and waits until the generation changes. Only
+    the first request starts a refresh, on a background thread. Drivers
+    asking later for the same generation wait for that refresh too, and
+    drivers asking for an older one go ahead at once.
+    """
+    POLL_INTERVAL = 0.1
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, path):
+        with cls._instances_lock:
+            credentials = cls._instances.get(path)
+            if credentials is None:
+                credentials = cls._instances[path] = \
+                    cls(DriverState.shared(path))
+            return credentials
+
+    def __init__(self, state):
+        self.logger = logging.getLogger('driver')
+        self.state = state
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.error = None
+        self._thread = None
+
+    def is_refreshing(self, generation):
+        with self.lock:
+            return self.generation == generation and self._thread is not None
+
+    def refresh(self, generation, headless):
+        """ Start refreshing the credentials of generation, unless done """
+        with self.lock:
+            if self.generation != generation or self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._refresh,
+                                            args=(headless,),
+                                            name='credentials')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _refresh(self, headless):
         state = self.state
-        if state.is_valid:
-            return
-        if not self.persistence:
-            raise Exception("Invalid state while running without persistence")
-        if not state.cookies:
-            if self.headless:
-                raise Exception("Invalid state while running in headless mode")
-            self.logger.info("Fetching cookies with Selenium")
-            state.cookies = fetch_cookies()
-            state.save()
-        if not state.xsrf or not state.gwt:
-            self.logger.info("Fetching xsrf and gwt tokens")
-            state.xsrf, state.gwt = fetch_tokens(state.cookies)
-            state.save()
+        error = None
+        try:
+            cookies = state.cookies
+            try:
+                if not cookies:
+                    raise Exception("No cookies")
+                self.logger.info("Fetching xsrf and gwt tokens")
+                xsrf, gwt = fetch_tokens(cookies)
+            except Exception:
+                # The cookies may have expired too
+                if headless:
+                    raise
+                self.logger.info("Fetching cookies with Selenium")
+                cookies = fetch_cookies()
+                xsrf, gwt = fetch_tokens(cookies)
+            state.update(cookies=cookies, xsrf=xsrf, gwt=gwt)
+        except Exception as e:
+            self.logger.error("Unable to refresh credentials: %s", e)
+            error = e
+            if headless and not state.cookies:
+                error = Exception(
+                    "Invalid state while running in headless mode")
+        with self.lock:
+            self.error = error
+            if error is None:
+                self.generation += 1
+            self._thread = None
 
 
 class DriverState(object):
+    """ Credentials shared in memory by every driver using the same path
+
+    save() coalesces writes made within SAVE_DELAY seconds into a single
+    atomic rewrite of the file, which is also flushed at exit. version
+    counts the changes of the tokens, so that responses to requests sent
+    with a replaced token cannot bring an older one back.
+    """
+    SAVE_DELAY = 1.0
+    FIELDS = ('cookies', 'xsrf', 'gwt')
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, path):
+        with cls._instances_lock:
+            state = cls._instances.get(path)
+            if state is None:
+                state = cls._instances[path] = cls(path)
+                atexit.register(state.close)
+            return state
+
     def __init__(self, path):
         self.path = path
+        self.lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._dirty = False
+        self._timer = None
+        self.version = 0
         self._load()
 
     def _load(self):
-        data = _load_json(self.path, {})
+        with _file_lock(self.path, fcntl.LOCK_SH):
+            data = _load_json(self.path, {})
+        # The file as last read or written, to merge with on flush()
+        self._saved = dict((k, data.get(k)) for k in self.FIELDS)
         self.cookies = data.get('cookies')
         self.xsrf = data.get('xsrf')
         self.gwt = data.get('gwt')
@@ -300,6 +589,69 @@ class DriverState(object):
     def is_valid(self):
         return self.cookies and self.xsrf and self.gwt
 
+    def update(self, **fields):
+        """ Replace credentials, e.g. xsrf=, and save them """
+        with self.lock:
+            for field, value in fields.iteritems():
+                setattr(self, field, value)
+            self.version += 1
+            self._save_locked()
+
+    def rotate_xsrf(self, xsrf, version):
+        """ Take the xsrf token of a response to a request sent at version,
+        unless the token has been replaced since """
+        with self.lock:
+            if version != self.version or xsrf == self.xsrf:
+                return
+            self.xsrf = xsrf
+            self.version += 1
+            self._save_locked()
+
     def save(self):
-        data = dict(cookies=self.cookies, xsrf=self.xsrf, gwt=self.gwt)
-        _save_json(self.path, data)
+        with self.lock:
+            self._save_locked()
+
+    def _save_locked(self):
+        self._dirty = True
+        if self._timer is None:
+            self._timer = threading.Timer(self.SAVE_DELAY, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def close(self):
+        """ Stop the timer of a pending save, e.g. at exit, and flush """
+        with self.lock:
+            timer = self._timer
+        if timer is not None:
+            # A timer woken up during interpreter shutdown fails noisily
+            timer.cancel()
+            timer.join()
+        self.flush()
+
+    def flush(self):
+        """ Write pending changes now
+
+        The file is re-read under an exclusive lock and only the fields
+        changed here since replace its own, so credentials another process
+        wrote meanwhile are kept, and taken up here.
+        """
+        with self._write_lock:
+            with self.lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if not self._dirty:
+                    return
+                self._dirty = False
+            with _file_lock(self.path):
+                data = _load_json(self.path, {})
+                with self.lock:
+                    for field in self.FIELDS:
+                        value = getattr(self, field)
+                        if value != self._saved[field]:
+                            data[field] = value
+                        elif data.get(field) != value:
+                            setattr(self, field, data.get(field))
+                            self.version += 1
+                    self._saved = dict((k, data.get(k)) for k in self.FIELDS)
+                save_json(self.path, data, indent=2, sort_keys=True)
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+""" Generator based coroutines shared by the threaded and async engines
+
+A coroutine is a generator yielding operations:
+
+  * another coroutine, which runs to completion and whose Return value is
+    sent back
+  * Request, performed with a requests.Session, the response is sent back
+  * Sleep, sent None once the delay has elapsed
+  * Emit, hands a value to whoever is running the coroutine
+  * Return, finishes the coroutine with a value
+"""
+import collections
+import heapq
+import itertools
+import metrics
+import Queue
+import sys
+import threading
+import time
+import tracing
+import types
+
+
+class Request(object):
+    def __init__(self, url, **kwargs):
+        self.url = url
+        self.kwargs = kwargs
+
+    def perform(self, session):
+        started_at = time.time()
+        try:
+            return session.post(self.url, **self.kwargs)
+        finally:
+            metrics.shared_metrics().thread_time(
+                'request', time.time() - started_at)
+            tracing.complete('request', started_at)
+
+
+class Sleep(object):
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+class Emit(object):
+    def __init__(self, value):
+        self.value = value
+
+
+class Return(object):
+    def __init__(self, value=None):
+        self.value = value
+
+
+class Task(object):
+    """ A trampolined stack of coroutines """
+    def __init__(self, coroutine, context=None):
+        self.stack = [coroutine]
+        self.context = context
+        self.result = None
+
+    def step(self, value=None, exc_info=None):
+        """ Advance until a Request, Sleep or Emit is yielded
+
+        Returns None once the outermost coroutine finishes.
+        """
+        stack = self.stack
+        while stack:
+            gen = stack[-1]
+            try:
+                if exc_info is not None:
+                    e, exc_info = exc_info, None
+                    op = gen.throw(*e)
+                else:
+                    op = gen.send(value)
+            except StopIteration:
+                stack.pop()
+                value = None
+                continue
+            except Exception:
+                stack.pop()
+                if not stack:
+                    raise
+                exc_info = sys.exc_info()
+                continue
+            value = None
+            if isinstance(op, types.GeneratorType):
+                stack.append(op)
+            elif isinstance(op, Return):
+                stack.pop().close()
+                value = self.result = op.value
+            else:
+                return op
+        return None
+
+    def close(self):
+        while self.stack:
+            self.stack.pop().close()
+
+
+def _drive(task, session):
+    value = exc_info = None
+    while True:
+        op = task.step(value, exc_info)
+        value = exc_info = None
+        if op is None:
+            return
+        elif isinstance(op, Emit):
+            yield op.value
+        elif isinstance(op, Sleep):
+            time.sleep(op.seconds)
+            metrics.shared_metrics().thread_time('sleep', op.seconds)
+        elif isinstance(op, Request):
+            try:
+                value = op.perform(session)
+            except Exception:
+                exc_info = sys.exc_info()
+        else:
+            raise TypeError("Unexpected operation %r" % op)
+
+
+def iterate(coroutine, session):
+    """ Run a coroutine on the calling thread, yielding emitted values """
+    return _drive(Task(coroutine), session)
+
+
+def call(coroutine, session):
+    """ Run a coroutine on the calling thread and return its result """
+    task = Task(coroutine)
+    for _ in _drive(task, session):
+        pass
+    return task.result
+
+
+class AsyncEngine(object):
+    """ Runs many coroutines on a single loop
+
+    At most `concurrency` coroutines are active at once. Their blocking
+    requests are handed to as many I/O threads sharing one session, while
+    sleeps are timers on the loop and hold no thread.
+    """
+    def __init__(self, session, concurrency=100):
+        self.session = session
+        self.concurrency = concurrency
+        self.cancelled = False
+        self._requests = Queue.Queue()
+        self._completions = Queue.Queue()
+        self._seq = itertools.count()
+        self._workers = []
+
+    def cancel(self):
+        self.cancelled = True
+
+    def _start_workers(self):
+        for ix in xrange(self.concurrency):
+            name = 'earwig-io-%s' % ix
+            thread = threading.Thread(target=self._worker, name=name)
+            thread.daemon = True
+            thread.start()
+            self._workers.append(thread)
+
+    def _stop_workers(self):
+        for _ in self._workers:
+            self._requests.put(None)
+        # Give idle workers a moment to exit, without waiting on requests
+        deadline = time.time() + 1
+        for thread in self._workers:
+            thread.join(max(0, deadline - time.time()))
+        self._workers = []
+
+    def _worker(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            task, request = item
+            try:
+                value, exc_info = request.perform(self.session), None
+            except Exception:
+                value, exc_info = None, sys.exc_info()
+            self._completions.put((task, value, exc_info))
+
+    def run(self, jobs):
+        """ Run (context, coroutine) jobs, yielding (context, value) pairs
+
+        Values are yielded as jobs Emit them. An exception raised by a job
+        cancels the remaining ones and propagates.
+        """
+        jobs = iter(jobs)
+        active = set()
+        ready = collections.deque()
+        timers = []
+        exhausted = False
+        self._start_workers()
+        try:
+            while not self.cancelled:
+                while not exhausted and len(active) < self.concurrency:
+                    job = next(jobs, None)
+                    if job is None:
+                        exhausted = True
+                        break
+                    context, coroutine = job
+                    task = Task(coroutine, context)
+                    active.add(task)
+                    ready.append((task, None, None))
+                if not active:
+                    break
+
+                while ready and not self.cancelled:
+                    task, value, exc_info = ready.popleft()
+                    op = task.step(value, exc_info)
+                    if op is None:
+                        active.discard(task)
+                    elif isinstance(op, Emit):
+                        ready.append((task, None, None))
+                        yield task.context, op.value
+                    elif isinstance(op, Sleep):
+                        deadline = time.time() + op.seconds
+                        heapq.heappush(timers, (deadline, next(self._seq), task))
+                    elif isinstance(op, Request):
+                        self._requests.put((task, op))
+                    else:
+                        raise TypeError("Unexpected operation %r" % op)
+                if self.cancelled or ready or not active or \
+                        (not exhausted and len(active) < self.concurrency):
+                    continue
+
+                # Bounded waits keep the loop responsive to KeyboardInterrupt
+                timeout = 0.5
+                if timers:
+                    timeout = min(timeout, max(0, timers[0][0] - time.time()))
+                try:
+                    ready.append(self._completions.get(timeout=timeout))
+                    while True:
+                        ready.append(self._completions.get_nowait())
+                except Queue.Empty:
+                    pass
+                now = time.time()
+                while timers and timers[0][0] <= now:
+                    ready.append((heapq.heappop(timers)[2], None, None))
+        finally:
+            self.cancelled = True
+            for task in active:
+                task.close()
+            self._stop_workers()
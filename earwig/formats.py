@@ -19,11 +19,17 @@ class FormatException(Exception):
         if leaf:
             message += ', leaf=%s' % _abbreviated_json(leaf, 16)
         super(FormatException, self).__init__(message)
+        self.msg = msg
         self.data = data
         self.spec = spec
         self.path = path
         self.leaf = leaf
 
+    def __reduce__(self):
+        # Allow instances to cross process boundaries, e.g. a flatten pool
+        return (FormatException,
+                (self.msg, self.data, self.spec, self.path, self.leaf))
+
 
 class Flattener(object):
     def __init__(self, data, spec):
@@ -36,7 +42,7 @@ class Flattener(object):
     def _validate_spec(self, spec, _type):
         if not isinstance(spec, _type):
             self._error("Invalid spec type %s != %s" %
-                        type(spec).__name__, _type.__name__)
+                        (type(spec).__name__, _type.__name__))
 
     def _error(self, msg, **kwargs):
         raise FormatException(msg, self.data, self.spec, self.path, **kwargs)
@@ -92,6 +98,193 @@ def flatten(data, spec):
     return Flattener(data, spec).flatten()
 
 
+class _PathError(Exception):
+    """ Raised by compiled flatteners; the path is rebuilt while unwinding """
+    def __init__(self, msg, leaf=None):
+        super(_PathError, self).__init__(msg)
+        self.msg = msg
+        self.path = ''
+        self.leaf = leaf
+
+
+class SpecCompiler(object):
+    """ Turns a spec into nested closures equivalent to Flattener
+
+    Keys, 'i_' conversions and generated names are resolved once at compile
+    time. Nodes are specialized on the path segment since the last list
+    boundary, which is all _generate_key depends on.
+    """
+    def __init__(self, spec):
+        if not isinstance(spec, dict):
+            raise FormatException("Invalid spec type %s != dict" %
+                                  type(spec).__name__, None, spec, '')
+        self.spec = spec
+        self._dict_nodes = {}
+        self._list_nodes = {}
+
+    def compile(self):
+        spec = self.spec
+        root_dict = self._dict_node(spec, '')
+        root_list = self._list_node(spec)
+
+        def flatten(data):
+            try:
+                if isinstance(data, dict):
+                    return root_dict(data, None)
+                elif isinstance(data, list):
+                    return root_list(data)
+                return data
+            except _PathError as e:
+                raise FormatException(e.msg, data, spec, e.path, leaf=e.leaf)
+        return flatten
+
+    def _dict_node(self, spec, seg):
+        memo_key = (id(spec), seg)
+        node = self._dict_nodes.get(memo_key)
+        if node is not None:
+            return node
+
+        if not isinstance(spec, dict):
+            msg = "Invalid spec type %s != dict" % type(spec).__name__
+            def node(src, dst):
+                raise _PathError(msg)
+            self._dict_nodes[memo_key] = node
+            return node
+
+        children = {}
+
+        def node(src, dst):
+            if dst is None:
+                dst = {}
+            k = None
+            try:
+                for k, v in src.iteritems():
+                    try:
+                        child = children[k]
+                    except KeyError:
+                        raise _PathError("Spec missing property %s" % k, leaf=v)
+                    if child is not None:
+                        child(v, dst)
+            except _PathError as e:
+                e.path = k + e.path
+                raise
+            return dst
+
+        # Register before compiling children so the memo is always populated
+        self._dict_nodes[memo_key] = node
+        for k, info in spec.iteritems():
+            children[k] = None if info is None else self._child(k, info, seg)
+        return node
+
+    def _list_node(self, spec):
+        memo_key = id(spec)
+        node = self._list_nodes.get(memo_key)
+        if node is not None:
+            return node
+        elem_dict = self._dict_node(spec, '')
+
+        def node(src):
+            array = []
+            append = array.append
+            try:
+                for elem in src:
+                    if isinstance(elem, dict):
+                        append(elem_dict(elem, None))
+                    elif isinstance(elem, list):
+                        append(node(elem))
+                    else:
+                        append(elem)
+            except _PathError as e:
+                e.path = '[' + e.path
+                raise
+            return array
+
+        self._list_nodes[memo_key] = node
+        return node
+
+    def _child(self, k, info, seg):
+        curr_seg = seg + k
+        if isinstance(info, basestring):
+            key = info
+        elif isinstance(info, dict):
+            key = info.get('name')
+        else:
+            type_name = type(info).__name__
+
+            def child(v, dst):
+                if isinstance(v, dict):
+                    raise _PathError("Invalid spec type %s != dict" % type_name)
+                raise _PathError("Invalid spec type %s" % type_name)
+            return child
+        key = key or 'f' + curr_seg
+
+        dict_node = self._dict_node(info, curr_seg)
+        list_node = self._list_node(info)
+
+        if key.startswith('i_'):
+            int_key = key[2:]
+
+            def child(v, dst):
+                if isinstance(v, dict):
+                    dict_node(v, dst)
+                    return
+                new_val = list_node(v) if isinstance(v, list) else v
+                if key in dst:
+                    raise _PathError("Key colision: %s" % key, leaf=v)
+                dst[int_key] = int(new_val)
+        else:
+            def child(v, dst):
+                if isinstance(v, dict):
+                    dict_node(v, dst)
+                    return
+                new_val = list_node(v) if isinstance(v, list) else v
+                if key in dst:
+                    raise _PathError("Key colision: %s" % key, leaf=v)
+                dst[key] = new_val
+        return child
+
+
+def compile_spec(spec):
+    """ Compile a spec into a function equivalent to flatten(data, spec) """
+    return SpecCompiler(spec).compile()
+
+
+def spec_columns(spec, lists, seg=''):
+    """ The keys flatten(data, spec) may produce, as (columns, children)
+
+    columns lists (key, type) pairs, where type is 'int' for 'i_' keys and
+    'str' otherwise. Dicts named in `lists` are expected to hold lists,
+    whose keys are in children[name], itself a (columns, children) pair.
+    Other dicts are merged into their parent, like flatten does.
+    """
+    columns = []
+    children = {}
+    seen = set()
+    for k in sorted(spec, key=lambda k: int(k) if k.isdigit() else k):
+        info = spec[k]
+        if k == 'name' or info is None:
+            continue
+        curr_seg = seg + k
+        if isinstance(info, dict):
+            key = info.get('name') or 'f' + curr_seg
+            if key in lists:
+                children[key] = spec_columns(info, lists)
+                continue
+            sub_columns, sub_children = spec_columns(info, lists, curr_seg)
+            children.update(sub_children)
+        else:
+            key = info or 'f' + curr_seg
+            if key.startswith('i_'):
+                sub_columns = [(key[2:], 'int')]
+            else:
+                sub_columns = [(key, 'str')]
+        for column in sub_columns:
+            if column[0] not in seen:
+                seen.add(column[0])
+                columns.append(column)
+    return columns, children
+
+
 def generate_spec(data, path=""):
     """ Generate a spec template given sample data """
     if isinstance(data, dict):
@@ -205,3 +398,107 @@ REPORT_SPEC = {
         "10": "deviceGlVersion"
     }
 }
+
+
+def _frame_key(frame):
+    try:
+        return frozenset(frame.iteritems())
+    except TypeError:
+        # Unhashable values, which flattened frames should not have
+        return ujson.dumps(frame, sort_keys=True)
+
+
+class FrameEncoder(object):
+    """ Dictionary-encode the stack frames of flattened reports
+
+    encode() returns the records to write for a report: if it uses frames
+    not seen before, a {"dictionary": ...} record appending them to the
+    frame table, then the report with each thread's stackTrace replaced by
+    frameIds, indices into that table. With stacks=True whole stacks are
+    interned too, and threads get a stackId into the stack table instead.
+
+    The first dictionary record of an encoder resets the tables, so the
+    outputs of several encoders can be concatenated.
+    """
+    def __init__(self, stacks=False):
+        self.stacks = stacks
+        self.frame_ids = {}
+        self.stack_ids = {}
+        self.reset = True
+
+    def _intern(self, ids, key, value, new_values):
+        ix = ids.get(key)
+        if ix is None:
+            ix = ids[key] = len(ids)
+            new_values.append(value)
+        return ix
+
+    def encode(self, report):
+        threads = report.get('threads')
+        if not threads:
+            return [report]
+        new_frames = []
+        new_stacks = []
+        encoded = []
+        for thread in threads:
+            frames = thread.get('stackTrace')
+            if frames is None:
+                encoded.append(thread)
+                continue
+            thread = dict(thread)
+            del thread['stackTrace']
+            frame_ids = [self._intern(self.frame_ids, _frame_key(frame),
+                                      frame, new_frames)
+                         for frame in frames]
+            if self.stacks:
+                thread['stackId'] = self._intern(
+                    self.stack_ids, tuple(frame_ids), frame_ids, new_stacks)
+            else:
+                thread['frameIds'] = frame_ids
+            encoded.append(thread)
+        report = dict(report, threads=encoded)
+        if not (new_frames or new_stacks):
+            return [report]
+        dictionary = {}
+        if self.reset:
+            dictionary['reset'] = True
+            self.reset = False
+        if new_frames:
+            dictionary['frames'] = new_frames
+        if new_stacks:
+            dictionary['stacks'] = new_stacks
+        return [{'dictionary': dictionary}, report]
+
+
+def expand_reports(records):
+    """ Yield the reports of FrameEncoder records in REPORT_SPEC shape
+
+    Plain reports pass through unchanged. Expanded reports share their
+    frame dicts, and stack lists, which must not be modified.
+    """
+    frames = []
+    stacks = []
+    for record in records:
+        dictionary = record.get('dictionary')
+        if dictionary is not None:
+            if dictionary.get('reset'):
+                frames = []
+                stacks = []
+            frames.extend(dictionary.get('frames', ()))
+            stacks.extend([frames[ix] for ix in frame_ids]
+                          for frame_ids in dictionary.get('stacks', ()))
+            continue
+        threads = record.get('threads')
+        if threads:
+            expanded = []
+            for thread in threads:
+                if 'stackId' in thread:
+                    thread = dict(thread)
+                    thread['stackTrace'] = stacks[thread.pop('stackId')]
+                elif 'frameIds' in thread:
+                    thread = dict(thread)
+                    thread['stackTrace'] = [frames[ix]
+                                            for ix in thread.pop('frameIds')]
+                expanded.append(thread)
+            record['threads'] = expanded
+        yield record
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+import bisect
+import threading
+import time
+import ujson
+
+from output import write_atomically
+
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30)
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """ The upper bound of the bucket holding quantile q """
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return dict(count=self.count, sum=self.sum, max=self.max,
+                    p50=self.quantile(0.5), p90=self.quantile(0.9),
+                    p99=self.quantile(0.99))
+
+
+def _labels_text(labels):
+    return ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                    for k, v in labels)
+
+
+def _series(name, labels):
+    if not labels:
+        return 'earwig_' + name
+    return 'earwig_%s{%s}' % (name, _labels_text(labels))
+
+
+class Metrics(object):
+    """ Counters, gauges and histograms of a run, keyed by name and labels
+
+    Thread-safe. summary() renders them as a dict for a JSON report and
+    prometheus() in the Prometheus text format, prefixed with earwig_.
+    Seconds spent per cluster flattening are only part of the summary, to
+    keep cluster ids out of Prometheus labels.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.cluster_seconds = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.iteritems())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.iteritems())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def set_max(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.iteritems())))
+        with self.lock:
+            if value > self.gauges.get(key, value - 1):
+                self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.iteritems())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def add_cluster_seconds(self, cluster_id, seconds):
+        with self.lock:
+            self.cluster_seconds[cluster_id] = \
+                self.cluster_seconds.get(cluster_id, 0) + seconds
+
+    def thread_time(self, state, seconds):
+        """ Account seconds the calling thread spent in state """
+        self.inc('thread_seconds_total', seconds,
+                 thread=threading.current_thread().name, state=state)
+
+    def summary(self):
+        """ Everything as nested dicts, with per-thread utilization """
+        rv = {}
+        with self.lock:
+            uptime = time.time() - self.started_at
+            values = [(k, v) for k, v in self.counters.iteritems()]
+            values += [(k, v) for k, v in self.gauges.iteritems()]
+            values += [(k, h.summary()) for k, h in self.histograms.iteritems()]
+            cluster_seconds = dict(self.cluster_seconds)
+        threads = {}
+        for (name, labels), value in values:
+            if not labels:
+                rv[name] = value
+                continue
+            rv.setdefault(name, {})[_labels_text(labels)] = value
+            if name == 'thread_seconds_total':
+                labels = dict(labels)
+                states = threads.setdefault(labels['thread'], {})
+                states[labels['state']] = value
+        rv['uptime_seconds'] = uptime
+        rv['flatten_seconds_by_cluster'] = cluster_seconds
+        rv['thread_utilization'] = dict(
+            (thread, dict((state, seconds / uptime)
+                          for state, seconds in states.iteritems()))
+            for thread, states in threads.iteritems())
+        return rv
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted(self.histograms.items())
+        typed = set()
+
+        def header(name, type_):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE earwig_%s %s' % (name, type_))
+
+        for kind, values in (('counter', counters), ('gauge', gauges)):
+            for (name, labels), value in values:
+                header(name, kind)
+                lines.append('%s %s' % (_series(name, labels), value))
+        for (name, labels), histogram in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            bounds = [repr(float(b)) for b in histogram.buckets] + ['+Inf']
+            for bound, n in zip(bounds, histogram.counts):
+                cumulative += n
+                lines.append('%s %s' % (
+                    _series(name + '_bucket', labels + (('le', bound),)),
+                    cumulative))
+            lines.append('%s %s' % (_series(name + '_sum', labels),
+                                    histogram.sum))
+            lines.append('%s %s' % (_series(name + '_count', labels),
+                                    histogram.count))
+        header('uptime_seconds', 'gauge')
+        lines.append('earwig_uptime_seconds %s' %
+                     (time.time() - self.started_at))
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path):
+        write_atomically(path, ujson.dumps(self.summary(), indent=2) + '\n')
+
+    def write_textfile(self, path):
+        write_atomically(path, self.prometheus())
+
+
+class TextfileWriter(object):
+    """ Rewrites a Prometheus textfile every `interval` seconds until closed
+    """
+    def __init__(self, metrics, path, interval=15):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='metrics')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.metrics.write_textfile(self.path)
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.metrics.write_textfile(self.path)
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_metrics():
+    """ The metrics every stage of this process records into """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = Metrics()
+        return _shared
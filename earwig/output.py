@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+import collections
+import formats
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import ujson
+import zlib
+
+from multiprocessing.pool import ThreadPool
+
+
+def makedirs_for(path):
+    subdir, _ = os.path.split(path)
+    if subdir and not os.path.exists(subdir):
+        os.makedirs(subdir)
+    if subdir and not os.path.isdir(subdir):
+        raise IOError('%s is not a directory' % subdir)
+
+
+def write_atomically(path, data):
+    """ Replace path with data, via a temporary file in the same directory """
+    dirname, basename = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname or '.', prefix='.' + basename)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
+def save_json(path, data, **kwargs):
+    """ Atomically replace path with data as JSON
+
+    kwargs are passed on to ujson.dumps.
+    """
+    write_atomically(path, ujson.dumps(data, **kwargs))
+
+
+class _Compressed(object):
+    def __init__(self, data):
+        self.data = data
+
+    def get(self):
+        return self.data
+
+
+class Compressor(object):
+    """ Compresses blocks into independent gzip members, pigz-style
+
+    Blocks are compressed on a pool of `threads` threads, shared by every
+    GzipWriter of a run, as zlib releases the GIL. Concatenated members
+    form a valid gzip file.
+    """
+    def __init__(self, level=6, threads=4, block_size=1 << 20):
+        self.level = level
+        self.threads = threads
+        self.block_size = block_size
+        self.pool = ThreadPool(threads) if threads > 1 else None
+        self.lock = threading.Lock()
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.seconds = 0
+
+    def _compress(self, data):
+        started_at = time.time()
+        # wbits=31 writes a gzip header and trailer around the deflate stream
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        member = compressor.compress(data) + compressor.flush()
+        with self.lock:
+            self.raw_bytes += len(data)
+            self.compressed_bytes += len(member)
+            self.seconds += time.time() - started_at
+        return member
+
+    def submit(self, data):
+        """ Start compressing data, returning a result with get() """
+        if self.pool is None:
+            return _Compressed(self._compress(data))
+        return self.pool.apply_async(self._compress, (data,))
+
+    def open(self, path):
+        return GzipWriter(open(path, 'wb'), self)
+
+    def stats(self):
+        """ Megabytes in and out so far, and the MB/s of a single thread """
+        return dict(raw_mb=self.raw_bytes / 1e6,
+                    compressed_mb=self.compressed_bytes / 1e6,
+                    mb_per_s=self.raw_bytes / 1e6 / max(self.seconds, 1e-6))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+class GzipWriter(object):
+    """ A write-only gzip file compressing blocks on a Compressor
+
+    Members are written to fp in order, with at most two per compressor
+    thread in flight.
+    """
+    def __init__(self, fp, compressor):
+        self.fp = fp
+        self.compressor = compressor
+        self.max_pending = 2 * max(1, compressor.threads)
+        self.buffer = []
+        self.buffered = 0
+        self.pending = collections.deque()
+        self.members = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.compressor.block_size:
+            self._submit()
+
+    def _submit(self):
+        self.pending.append(self.compressor.submit(''.join(self.buffer)))
+        self.buffer = []
+        self.buffered = 0
+        while len(self.pending) > self.max_pending:
+            self._write_member()
+
+    def _write_member(self):
+        self.fp.write(self.pending.popleft().get())
+        self.members += 1
+
+    def close(self):
+        # An empty file still gets one (empty) member
+        if self.buffer or not (self.members or self.pending):
+            self._submit()
+        while self.pending:
+            self._write_member()
+        self.fp.close()
+
+
+def _open(path, compressor, gzipped=None):
+    """ Open path for writing, gzipped if it, or else gzipped, says so """
+    if not (path.endswith('.gz') if gzipped is None else gzipped):
+        return open(path, 'wb')
+    return (compressor or Compressor(threads=1)).open(path)
+
+
+def _encoder(compact):
+    """ A FrameEncoder for the compact mode, None, 'frames' or 'stacks' """
+    if compact is None:
+        return None
+    return formats.FrameEncoder(stacks=compact == 'stacks')
+
+
+def _write_report(fp, encoder, report):
+    records = encoder.encode(report) if encoder is not None else (report,)
+    for record in records:
+        fp.write(ujson.dumps(record))
+        fp.write('\n')
+
+
+def read_reports(path):
+    """ Yield the reports of an output, expanding compact ones """
+    if path == '-':
+        f = sys.stdin
+    else:
+        f = gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+    try:
+        for report in formats.expand_reports(ujson.loads(line) for line in f):
+            yield report
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+class Output(object):
+    """ Newline delimited JSON reports, gzipped for .gz paths
+
+    Reports are written to a .part file renamed into place by commit(), so
+    an existing output is always complete. '-' writes to stdout. With
+    compact='frames' or 'stacks', reports are dictionary-encoded by a
+    formats.FrameEncoder, and read_reports() expands them back.
+    """
+    def __init__(self, path, compressor=None, compact=None):
+        self.path = path
+        self.count = 0
+        self.encoder = _encoder(compact)
+        if path == '-':
+            self.tmp_path = None
+            self.fp = sys.stdout
+            return
+        makedirs_for(path)
+        self.tmp_path = path + '.part'
+        self.fp = _open(self.tmp_path, compressor, path.endswith('.gz'))
+
+    def write(self, cluster_id, report):
+        _write_report(self.fp, self.encoder, report)
+        self.count += 1
+
+    def cluster_done(self, cluster_id):
+        pass
+
+    def commit(self):
+        if self.tmp_path is None:
+            self.fp.flush()
+            return
+        self.fp.close()
+        os.rename(self.tmp_path, self.path)
+
+    def abort(self):
+        if self.tmp_path is None:
+            self.fp.flush()
+            return
+        self.fp.close()
+        os.unlink(self.tmp_path)
+
+
+class SegmentedOutput(object):
+    """ Resumable output, with one finalized segment per cluster
+
+    Each cluster is written to its own segment under path.segments and
+    recorded in the path.manifest sidecar once complete. A rerun of the
+    same window skips the clusters in completed_clusters(). commit()
+    concatenates the segments, which are gzip members for .gz paths, into
+    path and removes the sidecars. Each segment has its own FrameEncoder
+    in compact mode.
+    """
+    def __init__(self, path, window, compressor=None, compact=None):
+        self.path = path
+        self.compressor = compressor
+        self.compact = compact
+        self.ext = '.json.gz' if path.endswith('.gz') else '.json'
+        self.segments_dir = path + '.segments'
+        self.manifest_path = path + '.manifest'
+        self.identity = dict(bundleId=window.bundle_id,
+                             startTime=window.start_time,
+                             endTime=window.end_time)
+        self.count = 0
+        self.open_segments = {}
+        makedirs_for(path)
+        manifest = self._load_manifest()
+        if manifest is None:
+            shutil.rmtree(self.segments_dir, True)
+            manifest = dict(self.identity, clusters=[])
+        self.manifest = manifest
+        self.next_segment = 1 + max([c['segment'] or 0
+                                     for c in manifest['clusters']] or [0])
+        if not os.path.isdir(self.segments_dir):
+            os.makedirs(self.segments_dir)
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path, 'rb') as f:
+                manifest = ujson.load(f)
+        except (IOError, ValueError):
+            return None
+        for k, v in self.identity.iteritems():
+            if manifest.get(k) != v:
+                return None
+        return manifest
+
+    def completed_clusters(self):
+        return set(c['clusterId'] for c in self.manifest['clusters'])
+
+    def _segment_path(self, segment):
+        return os.path.join(self.segments_dir, '%05d%s' % (segment, self.ext))
+
+    def write(self, cluster_id, report):
+        entry = self.open_segments.get(cluster_id)
+        if entry is None:
+            segment = self.next_segment
+            self.next_segment += 1
+            path = self._segment_path(segment)
+            entry = self.open_segments[cluster_id] = \
+                [segment, _open(path, self.compressor), 0,
+                 _encoder(self.compact)]
+        _write_report(entry[1], entry[3], report)
+        entry[2] += 1
+        self.count += 1
+
+    def cluster_done(self, cluster_id):
+        segment, fp, count, _ = self.open_segments.pop(cluster_id,
+                                                       (None, None, 0, None))
+        if fp is not None:
+            fp.close()
+        self.manifest['clusters'].append(
+            dict(clusterId=cluster_id, segment=segment, count=count))
+        save_json(self.manifest_path, self.manifest)
+
+    def commit(self):
+        tmp_path = self.path + '.part'
+        segments = [c['segment'] for c in self.manifest['clusters']
+                    if c['segment'] is not None]
+        if segments:
+            with open(tmp_path, 'wb') as out:
+                for segment in segments:
+                    with open(self._segment_path(segment), 'rb') as f:
+                        shutil.copyfileobj(f, out)
+        else:
+            # An empty output still gets one (empty) gzip member
+            _open(tmp_path, self.compressor, self.ext == '.json.gz').close()
+        os.rename(tmp_path, self.path)
+        self.count = sum(c['count'] for c in self.manifest['clusters'])
+        # Windows without clusters never wrote a manifest
+        if os.path.exists(self.manifest_path):
+            os.unlink(self.manifest_path)
+        shutil.rmtree(self.segments_dir, True)
+
+    def abort(self):
+        """ Drop unfinished clusters, keeping completed ones for a rerun """
+        for segment, fp, _, _ in self.open_segments.itervalues():
+            fp.close()
+            os.unlink(self._segment_path(segment))
+        self.open_segments = {}
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+import collections
+import threading
+import time
+
+
+class RateLimiter(object):
+    """ A token bucket whose rate adapts to throttling (AIMD)
+
+    Without a `rate`, requests are let through at up to `max_rate`, or
+    without any limit, until the first throttle, which starts the bucket
+    at `decrease` times the rate requests were last being issued at.
+    Every success raises the rate by `increase` requests per second, up to
+    `max_rate`. A throttled request multiplies it by `decrease` and pauses
+    all callers, for `pause` seconds growing 1.5 times per consecutive
+    throttle. The bucket is emptied and refills from the end of the pause,
+    so callers resume spaced out at the new rate instead of at once.
+    Throttles of requests issued before the last backoff are
+    ignored, so a burst of in-flight failures only backs off once.
+    """
+    def __init__(self, rate=None, burst=10, min_rate=0.1, max_rate=None,
+                 increase=0.1, decrease=0.5, pause=30):
+        self.lock = threading.Lock()
+        rate = rate or max_rate
+        # None while unlimited
+        self._rate = float(rate) if rate else None
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.base_pause = pause
+        self.pause = pause
+        self.tokens = float(burst)
+        self.updated_at = time.time()
+        self.resume_at = 0
+        self.backoff_at = 0
+        # When the latest requests were issued, while unlimited
+        self.issued = collections.deque(maxlen=50)
+
+    @property
+    def rate(self):
+        """ The current rate, in requests per second, None if unlimited """
+        return self._rate
+
+    def set_max_rate(self, max_rate):
+        """ Cap the rate, from now on, at max_rate requests per second """
+        with self.lock:
+            self.max_rate = max_rate
+            if self._rate is None or self._rate > max_rate:
+                self._refill(time.time())
+                self._rate = float(max_rate)
+
+    def _issued_rate(self):
+        """ The rate the latest requests were issued at while unlimited """
+        if len(self.issued) > 1:
+            elapsed = self.issued[-1] - self.issued[0]
+            if elapsed > 0:
+                return (len(self.issued) - 1) / elapsed
+        return float(self.burst)
+
+    def _refill(self, now):
+        # updated_at is in the future during a pause
+        elapsed = now - self.updated_at
+        if self._rate is None:
+            self.updated_at = max(now, self.updated_at)
+        elif elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self._rate)
+            self.updated_at = now
+
+    def reserve(self):
+        """ Take a token, returning how long to wait before using it """
+        with self.lock:
+            now = time.time()
+            self._refill(now)
+            if self._rate is None:
+                self.issued.append(now)
+                return 0
+            self.tokens -= 1
+            delay = -self.tokens / self._rate if self.tokens < 0 else 0
+            return max(0, self.updated_at - now) + delay
+
+    def on_success(self):
+        with self.lock:
+            self._refill(time.time())
+            if self._rate is not None:
+                self._rate += self.increase
+                if self.max_rate is not None:
+                    self._rate = min(self.max_rate, self._rate)
+            self.pause = self.base_pause
+
+    def on_throttle(self, issued_at):
+        """ Back off for a request issued at `issued_at`
+
+        Returns the remaining global pause, in seconds.
+        """
+        with self.lock:
+            now = time.time()
+            if issued_at >= self.backoff_at:
+                self._refill(now)
+                if self._rate is None:
+                    self._rate = self._issued_rate()
+                self._rate = max(self.min_rate, self._rate * self.decrease)
+                self.resume_at = now + self.pause
+                self.tokens = 0.0
+                self.updated_at = self.resume_at
+                self.backoff_at = now
+                self.pause *= 1.5
+            return max(0, self.resume_at - now)
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_limiter():
+    """ The limiter used by every PlayDriver in this process by default """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = RateLimiter()
+        return _shared
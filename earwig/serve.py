@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+import cli
+import logging
+import metrics
+import os
+import sys
+import time
+import tracing
+import ujson
+
+from output import makedirs_for, save_json
+from transport import Transport
+
+
+DEFAULT_OUTPUT = 'output/{account_id}/{bundle_id}/%Y%m%d/%H.json.gz'
+DEFAULT_STATS_OUTPUT = 'output/{account_id}/{bundle_id}/%Y%m%d/%H.stats.json.gz'
+DEFAULT_STATUS = '~/.earwig/status.json'
+# A failed hour is retried after this many seconds, doubling every attempt
+RETRY_DELAY = 300
+# ...at most this many times
+MAX_RETRIES = 5
+
+
+class Target(object):
+    """ A bundle downloaded hour by hour, how its last run went and the
+    failed hours left to retry """
+    def __init__(self, account_id, bundle_id, output):
+        self.account_id = account_id
+        self.bundle_id = bundle_id
+        self.output = output
+        self.last_run = None
+        self.last_success = None
+        self.failures = 0
+        # Failed hours, mapped to [attempts, retry_at]
+        self.retries = {}
+
+    def path(self, hour):
+        return cli.output_path(self.output, hour, self.account_id,
+                               self.bundle_id)
+
+    def succeeded(self, hour):
+        self.retries.pop(hour, None)
+        if self.last_success is None or hour > self.last_success:
+            self.last_success = hour
+
+    def failed(self, hour, now):
+        """ Schedule hour for a retry, False when out of attempts """
+        self.failures += 1
+        attempts = self.retries.get(hour, (0, None))[0] + 1
+        if attempts > MAX_RETRIES:
+            self.retries.pop(hour, None)
+            return False
+        self.retries[hour] = [attempts,
+                              now + RETRY_DELAY * 2 ** (attempts - 1)]
+        return True
+
+    def due_retries(self, now):
+        return [hour for hour, (_, retry_at) in self.retries.iteritems()
+                if retry_at <= now]
+
+    def status(self):
+        retries = [dict(window_start=hour, attempts=attempts,
+                        retry_at=retry_at)
+                   for hour, (attempts, retry_at)
+                   in sorted(self.retries.iteritems())]
+        return dict(account_id=self.account_id, bundle_id=self.bundle_id,
+                    last_run=self.last_run, last_success=self.last_success,
+                    failures=self.failures, retries=retries)
+
+    def restore(self, status):
+        """ Pick up where a previous server's status() left off """
+        self.last_success = status.get('last_success')
+        self.failures = status.get('failures') or 0
+        for retry in status.get('retries') or []:
+            self.retries[retry['window_start']] = [retry['attempts'],
+                                                   retry['retry_at']]
+
+
+def trace_path(path, hour):
+    """ The trace of an hour, path suffixed with the hour, e.g.
+    run.2024010112.json """
+    base, ext = os.path.splitext(path)
+    return '%s.%s%s' % (base, time.strftime('%Y%m%d%H', time.localtime(hour)),
+                        ext)
+
+
+def load_targets(path, output=DEFAULT_OUTPUT):
+    """ Read the bundles to serve from a JSON config
+
+    The config holds a "bundles" list of objects with an "account_id", a
+    "bundle_id" and optionally an "output" pattern, defaulting to the
+    config's "output" or else to `output`. Patterns are strftime patterns
+    where {account_id} and {bundle_id} are substituted.
+    """
+    with open(path, 'rb') as f:
+        config = ujson.load(f)
+    output = config.get('output', output)
+    targets = []
+    for entry in config.get('bundles') or []:
+        try:
+            targets.append(Target(entry['account_id'], entry['bundle_id'],
+                                  entry.get('output', output)))
+        except (KeyError, TypeError):
+            raise ValueError('invalid bundle in %s: %r' % (path, entry))
+    return targets
+
+
+class Server(object):
+    """ Downloads each target's hours as they close, forever
+
+    An hour is downloaded `delay` seconds after it ends, starting with the
+    hour before the server started, for every target at once on shared
+    workers. Runs share one connection pool, the flatten pool and the
+    in-memory credentials, so they start warm. A status file records each
+    target's last run, its lag behind the end of its window and its
+    throughput.
+
+    A target's failed hours are retried RETRY_DELAY seconds later, backing
+    off exponentially, up to MAX_RETRIES times. The retries are kept in the
+    status file, and a restarted server picks them up.
+    """
+    def __init__(self, opts, targets, delay=60, status_path=None, pool=None):
+        self.logger = logging.getLogger('serve')
+        self.opts = opts
+        self.pool = pool
+        self.targets = targets
+        self.delay = delay
+        self.status_path = status_path
+        self.started_at = time.time()
+        self.transport = Transport(pool_size=max(10, opts.threads))
+        self.next_hour = cli._previous_hour()
+        self._load_status()
+
+    def _load_status(self):
+        if not self.status_path:
+            return
+        try:
+            with open(self.status_path, 'rb') as f:
+                status = ujson.load(f)
+        except (IOError, ValueError):
+            return
+        targets = dict(((target.account_id, target.bundle_id), target)
+                       for target in self.targets)
+        for entry in status.get('targets') or []:
+            target = targets.get((entry.get('account_id'),
+                                  entry.get('bundle_id')))
+            if target is None:
+                continue
+            try:
+                target.restore(entry)
+            except (KeyError, TypeError, ValueError):
+                self.logger.warning("Ignoring the invalid status of %s",
+                                    target.bundle_id)
+
+    def _closed_hour(self):
+        """ The end of the last hour due for download """
+        return cli._truncate_to_hour(time.time() - self.delay)
+
+    def _next_run_at(self):
+        return self.next_hour + 3600 + self.delay
+
+    def _wake_at(self):
+        """ When the next hour closes or the next retry is due """
+        return min([self._next_run_at()] +
+                   [retry_at for target in self.targets
+                    for _, retry_at in target.retries.itervalues()])
+
+    def write_status(self):
+        if not self.status_path:
+            return
+        makedirs_for(self.status_path)
+        save_json(self.status_path, dict(
+            pid=os.getpid(), started_at=self.started_at,
+            next_run_at=self._next_run_at(),
+            targets=[target.status() for target in self.targets]),
+            indent=2, sort_keys=True)
+
+    def _failed(self, target, hour):
+        if target.failed(hour, time.time()):
+            attempts, retry_at = target.retries[hour]
+            self.logger.warning("Retrying %s of %s at %s", target.bundle_id,
+                                time.ctime(hour), time.ctime(retry_at))
+        else:
+            self.logger.error("Giving up on %s of %s after %d attempts, "
+                              "see earwig backfill", target.bundle_id,
+                              time.ctime(hour), MAX_RETRIES + 1)
+
+    def download(self, hour, targets=None):
+        """ Download one hour of the targets lacking it, all by default """
+        opts = self.opts
+        compressor = cli._compressor(opts)
+        windows = []
+        outputs = {}
+        targets_by_window = {}
+        try:
+            for target in targets or self.targets:
+                path = target.path(hour)
+                if os.path.exists(path):
+                    self.logger.info("Skipping %s, already downloaded", path)
+                    target.succeeded(hour)
+                    continue
+                makedirs_for(path)
+                window = cli.Window(target.bundle_id, hour, hour + 3600,
+                                    target.account_id)
+                outputs[window] = cli._output(path, window, compressor,
+                                              opts.compact, opts.stats_only)
+                targets_by_window[window] = target
+                windows.append(window)
+            if windows:
+                earwig = cli._earwig(opts, hour, hour + 3600, windows,
+                                     account_id=windows[0].account_id,
+                                     bundle_id=windows[0].bundle_id,
+                                     transport=self.transport,
+                                     pool=self.pool)
+        except BaseException:
+            # sink() did not take them over
+            for output in outputs.itervalues():
+                output.abort()
+            compressor.close()
+            raise
+        if not windows:
+            compressor.close()
+            return
+        if opts.trace:
+            tracing.start()
+        started_at = time.time()
+        try:
+            cli.sink(earwig, outputs, compressor)
+        finally:
+            if opts.trace:
+                tracing.stop(trace_path(opts.trace, hour))
+        for window in windows:
+            target = targets_by_window[window]
+            rc = 0 if window.done_at else earwig.rc or 1
+            finished_at = window.done_at or time.time()
+            seconds = finished_at - started_at
+            n = outputs[window].count
+            target.last_run = dict(
+                window_start=hour, started_at=started_at,
+                finished_at=finished_at, rc=rc, reports=n, seconds=seconds,
+                reports_per_second=n / seconds if seconds else 0,
+                lag_seconds=finished_at - window.end_time)
+            if rc:
+                self.logger.error("Downloading %s failed: %s", window, rc)
+                self._failed(target, hour)
+            else:
+                target.succeeded(hour)
+        if earwig.rc == 2:
+            raise KeyboardInterrupt
+
+    def _attempt(self, hour, targets):
+        """ Download an hour of targets, scheduling retries on errors """
+        try:
+            self.download(hour, targets)
+        except Exception:
+            self.logger.exception("Downloading %s failed", time.ctime(hour))
+            for target in targets:
+                self._failed(target, hour)
+        self.write_status()
+        if self.opts.metrics:
+            metrics.shared_metrics().write_json(self.opts.metrics)
+
+    def _due_retries(self):
+        """ (hour, targets) pairs due for a retry, oldest hour first """
+        now = time.time()
+        due = {}
+        for target in self.targets:
+            for hour in target.due_retries(now):
+                due.setdefault(hour, []).append(target)
+        return sorted(due.iteritems())
+
+    def run(self):
+        registry = metrics.shared_metrics()
+        textfile = None
+        if self.opts.prometheus:
+            textfile = metrics.TextfileWriter(registry, self.opts.prometheus)
+        try:
+            while True:
+                while self.next_hour + 3600 <= self._closed_hour():
+                    hour = self.next_hour
+                    # Failures are retried from the targets' backlogs
+                    self.next_hour += 3600
+                    self._attempt(hour, self.targets)
+                for hour, targets in self._due_retries():
+                    self._attempt(hour, targets)
+                self.write_status()
+                wake_at = self._wake_at()
+                self.logger.info("Next run at %s", time.ctime(wake_at))
+                time.sleep(max(0, wake_at - time.time()))
+        except KeyboardInterrupt:
+            self.logger.info("Stopping")
+        finally:
+            if textfile is not None:
+                textfile.close()
+
+
+def serve(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='earwig serve',
+        description="Download the configured bundles' reports every hour, "
+        "as soon as each hour closes")
+    parser.add_argument('-o', '--output',
+                        help='specify the default output pattern, with '
+                        '{account_id} and {bundle_id} substituted '
+                        '(default: %s, or .stats.json.gz with --stats-only)'
+                        % DEFAULT_OUTPUT.replace('%', '%%'))
+    parser.add_argument('--delay', default=60, type=int,
+                        help='seconds to wait after an hour ends before '
+                        'downloading it (default: 60)')
+    parser.add_argument('--status', default=DEFAULT_STATUS, metavar='PATH',
+                        help='keep the status of the last runs in this '
+                        'file (default: %s)' % DEFAULT_STATUS)
+    cli._add_common_arguments(parser, targets=False)
+    parser.add_argument('config',
+                        help='a JSON file listing the bundles to download')
+
+    opts = parser.parse_args(argv)
+    cli._setup_logging(opts)
+    try:
+        targets = load_targets(opts.config, opts.output or (
+            DEFAULT_STATS_OUTPUT if opts.stats_only else DEFAULT_OUTPUT))
+    except (IOError, ValueError) as e:
+        cli._error(str(e))
+    if not targets:
+        cli._error('no bundles in %s' % opts.config)
+    # Exit on bad options and outputs now, not from the first hour's run
+    cli._rate_limit(opts)
+    cli._cache(opts)
+    for target in targets:
+        cli._check_output(target.output, opts.stats_only)
+
+    # Runs share the -w pool, forked before any thread is started
+    pool = cli._flatten_pool(opts)
+    server = Server(opts, targets, opts.delay,
+                    os.path.expanduser(opts.status), pool)
+    try:
+        server.run()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    sys.exit(0)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+""" Span timelines in the Chrome Trace Event format, for Perfetto
+
+Tracing is off until start(), and every function here returns at once
+while it is. Work on a thread is recorded as complete ('X') events, while
+coroutine work, which the async engine interleaves on one thread, is
+recorded as nestable async ('b'/'e') events keyed by an id.
+"""
+import itertools
+import os
+import threading
+import time
+import ujson
+
+
+class Tracer(object):
+    def __init__(self):
+        self.pid = os.getpid()
+        self.started_at = time.time()
+        # list.append is atomic, so events need no lock
+        self.events = []
+        self.threads = set()
+        self.ids = itertools.count(1)
+
+    def _tid(self):
+        thread = threading.current_thread()
+        tid = thread.ident
+        if tid not in self.threads:
+            self.threads.add(tid)
+            self.events.append(dict(ph='M', name='thread_name', pid=self.pid,
+                                    tid=tid, args=dict(name=thread.name)))
+        return tid
+
+    def _ts(self, t):
+        return (t - self.started_at) * 1e6
+
+    def complete(self, name, started_at, args):
+        self.events.append(dict(
+            ph='X', cat='earwig', name=name, pid=self.pid, tid=self._tid(),
+            ts=self._ts(started_at), dur=(time.time() - started_at) * 1e6,
+            args=args))
+
+    def begin(self, name, args, id_=None):
+        id_ = id_ or next(self.ids)
+        args['thread'] = threading.current_thread().name
+        self.events.append(dict(
+            ph='b', cat='earwig', name=name, id=id_, pid=self.pid,
+            tid=self._tid(), ts=self._ts(time.time()), args=args))
+        return id_
+
+    def end(self, name, id_):
+        self.events.append(dict(
+            ph='e', cat='earwig', name=name, id=id_, pid=self.pid,
+            tid=self._tid(), ts=self._ts(time.time())))
+
+    def write(self, path):
+        with open(path, 'wb') as f:
+            ujson.dump(dict(traceEvents=self.events, displayTimeUnit='ms'), f)
+
+
+class _Span(object):
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.started_at = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.complete(self.name, self.started_at, self.args)
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+_tracer = None
+
+
+def start():
+    global _tracer
+    _tracer = Tracer()
+
+
+def stop(path):
+    """ Stop tracing, writing the events recorded so far to path """
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.write(path)
+
+
+def span(name, **args):
+    """ A context manager recording its block as a span of this thread """
+    tracer = _tracer
+    if tracer is None:
+        return _NULL_SPAN
+    return _Span(tracer, name, args)
+
+
+def complete(name, started_at, **args):
+    """ Record a span of this thread which started at `started_at` """
+    tracer = _tracer
+    if tracer is not None:
+        tracer.complete(name, started_at, args)
+
+
+def begin(name, id_=None, **args):
+    """ Begin an async span, returning the id to end it with
+
+    Spans begun with the id of an open span nest inside it.
+    """
+    tracer = _tracer
+    if tracer is not None:
+        return tracer.begin(name, args, id_)
+
+
+def end(name, id_):
+    tracer = _tracer
+    if tracer is not None and id_ is not None:
+        tracer.end(name, id_)
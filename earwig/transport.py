@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+import requests
+import socket
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection
+
+
+def _keepalive_options():
+    options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    # Probe idle connections well before Google's frontends drop them
+    for name, value in (('TCP_KEEPIDLE', 60), ('TCP_KEEPINTVL', 15),
+                        ('TCP_KEEPCNT', 4)):
+        if hasattr(socket, name):
+            options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+    return HTTPConnection.default_socket_options + options
+
+
+class _KeepAliveAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = _keepalive_options()
+        super(_KeepAliveAdapter, self).init_poolmanager(*args, **kwargs)
+
+
+class Transport(object):
+    """ A pooled requests.Session shared by every driver of a run
+
+    Up to `pool_size` connections per host are kept alive, which should be
+    at least the number of concurrent requests.
+    """
+    def __init__(self, pool_size=10):
+        self.pool_size = pool_size
+        self.adapter = _KeepAliveAdapter(pool_connections=4,
+                                         pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        self.session.headers['Connection'] = 'keep-alive'
+
+    def stats(self):
+        """ Count requests, and new versus reused connections, so far """
+        requests_ = connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                requests_ += pool.num_requests
+                connections += pool.num_connections
+        return dict(requests=requests_, connections=connections,
+                    reused=requests_ - connections)
@@ -19,4 +19,7 @@ setup(name='earwig',
           'requests',
           'selenium',
           'ujson'
-      ])
+      ],
+      extras_require={
+          'columnar': ['pyarrow']
+      })